@@ -0,0 +1,3 @@
+"""
+Benchmarks for the jhhalchemy Base CRUD methods and TimeOrder range queries
+"""
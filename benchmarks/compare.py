@@ -0,0 +1,60 @@
+"""
+Compare two benchmark result files from benchmarks.run:
+
+    python -m benchmarks.compare bench-0.7.3-mysql.json bench-0.8-mysql.json --threshold 0.1
+
+Prints the throughput and p99 latency change for every scenario and table size both files have. Exits with status 1 if
+any scenario's throughput dropped by more than the threshold.
+"""
+import argparse
+import json
+import sys
+
+
+def compare(baseline, current, threshold):
+    """
+    :param baseline: baseline report dict
+    :param current: current report dict
+    :param threshold: allowed throughput drop as a fraction
+    :return: (list of report lines, list of regressed (rows, scenario) pairs)
+    """
+    lines = ['{:>10} {:<14} {:>14} {:>14} {:>9} {:>9}'.format(
+        'rows', 'scenario', 'baseline/s', 'current/s', 'change', 'p99')]
+    regressions = []
+    for rows in sorted(set(baseline['runs']) & set(current['runs']), key=int):
+        for scenario in sorted(set(baseline['runs'][rows]) & set(current['runs'][rows])):
+            before = baseline['runs'][rows][scenario]
+            after = current['runs'][rows][scenario]
+            if not before['throughput'] or not after['throughput']:
+                continue
+            change = after['throughput'] / before['throughput'] - 1
+            p99 = after['p99_ms'] / before['p99_ms'] - 1 if before['p99_ms'] else 0
+            lines.append('{:>10} {:<14} {:>14.1f} {:>14.1f} {:>+8.1%} {:>+8.1%}'.format(
+                rows, scenario, before['throughput'], after['throughput'], change, p99))
+            if change < -threshold:
+                regressions.append((rows, scenario))
+    return lines, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('baseline', help='baseline result file')
+    parser.add_argument('current', help='current result file')
+    parser.add_argument('--threshold', type=float, default=0.1, help='allowed throughput drop, default 0.1 (10%%)')
+    args = parser.parse_args()
+
+    with open(args.baseline) as baseline_file, open(args.current) as current_file:
+        baseline = json.load(baseline_file)
+        current = json.load(current_file)
+    print('{} ({}) -> {} ({})'.format(
+        baseline['version'], baseline['dialect'], current['version'], current['dialect']))
+    lines, regressions = compare(baseline, current, args.threshold)
+    print('\n'.join(lines))
+    if regressions:
+        print('Regressions: {}'.format(
+            ', '.join('{} at {} rows'.format(scenario, rows) for rows, scenario in regressions)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,273 @@
+"""
+Latency and query plan instrumentation for the jhhalchemy query helpers.
+
+The helpers tag their queries with the model and helper names as execution options. instrument() hooks an engine's
+cursor events and records a latency histogram and row count per (model, helper):
+
+recorder = jhhalchemy.instrument.instrument(db.engine, slow_seconds=0.5)
+recorder.snapshot()
+"""
+import bisect
+import logging
+import sqlalchemy
+import sqlalchemy.event
+import threading
+import time
+
+#
+# Execution options the helpers tag their queries with
+#
+MODEL_OPTION = 'jhhalchemy_model'
+HELPER_OPTION = 'jhhalchemy_helper'
+
+#
+# Upper bounds of the latency histogram buckets in seconds. The last bucket holds everything slower.
+#
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+logger = logging.getLogger(__name__)
+
+
+def tag(query, model_cls=None, helper=None):
+    """
+    Tag a query with the model and helper it came from. Later tags override earlier ones, so a helper built on another
+    helper can retag the query.
+
+    :param query: SQLAlchemy Query
+    :param model_cls: model class
+    :param helper: helper name
+    :return: tagged query
+    """
+    options = {}
+    if model_cls is not None:
+        options[MODEL_OPTION] = model_cls.__name__
+    if helper is not None:
+        options[HELPER_OPTION] = helper
+    return query.execution_options(**options)
+
+
+class Histogram(object):
+    """
+    Latency histogram with row counts
+    """
+    def __init__(self, buckets=BUCKETS):
+        """
+        :param buckets: ascending bucket upper bounds in seconds
+        """
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.rows = 0
+
+    def observe(self, seconds, rows):
+        """
+        Record one query.
+
+        :param seconds: query latency
+        :param rows: rows returned or affected
+        """
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        self.rows += max(rows, 0)
+
+    def as_dict(self):
+        """
+        :return: dict of the counters, buckets are keyed by upper bound ('inf' for the last one)
+        """
+        bounds = [str(bound) for bound in self.buckets] + ['inf']
+        return {
+            'count': self.count,
+            'seconds': self.seconds,
+            'max_seconds': self.max_seconds,
+            'rows': self.rows,
+            'buckets': dict(zip(bounds, self.counts))}
+
+
+class LoggingEmitter(object):
+    """
+    Log every instrumented query
+    """
+    def __init__(self, emit_logger=logger, level=logging.DEBUG):
+        """
+        :param emit_logger: logger to write to
+        :param level: log level
+        """
+        self.logger = emit_logger
+        self.level = level
+
+    def emit(self, model, helper, seconds, rows):
+        """
+        :param model: model class name
+        :param helper: helper name
+        :param seconds: query latency
+        :param rows: rows returned or affected
+        """
+        self.logger.log(self.level, '{}.{} took {:.1f}ms for {} rows'.format(model, helper, seconds * 1000, rows))
+
+
+class StatsdEmitter(object):
+    """
+    Send every instrumented query to a statsd client with timing(stat, ms) and incr(stat, count) methods, e.g. the
+    statsd package's StatsClient. Stats are named <prefix>.<model>.<helper>.
+    """
+    def __init__(self, client, prefix='jhhalchemy'):
+        """
+        :param client: statsd client
+        :param prefix: stat name prefix
+        """
+        self.client = client
+        self.prefix = prefix
+
+    def emit(self, model, helper, seconds, rows):
+        """
+        :param model: model class name
+        :param helper: helper name
+        :param seconds: query latency
+        :param rows: rows returned or affected
+        """
+        stat = '{}.{}.{}'.format(self.prefix, model, helper)
+        self.client.timing(stat, seconds * 1000)
+        self.client.incr(stat + '.rows', max(rows, 0))
+
+
+class Recorder(object):
+    """
+    Collects the histograms and query plan warnings for instrumented engines
+    """
+    def __init__(self, emitters=()):
+        """
+        :param emitters: objects with an emit(model, helper, seconds, rows) method, called for every query
+        """
+        self.emitters = list(emitters)
+        self.histograms = {}
+        #
+        # statement -> list of query plan problems, or None if EXPLAIN failed
+        #
+        self.plans = {}
+        self._lock = threading.Lock()
+
+    def record(self, model, helper, seconds, rows):
+        """
+        Record one query.
+
+        :param model: model class name
+        :param helper: helper name
+        :param seconds: query latency
+        :param rows: rows returned or affected
+        """
+        with self._lock:
+            histogram = self.histograms.get((model, helper))
+            if histogram is None:
+                histogram = self.histograms[(model, helper)] = Histogram()
+            histogram.observe(seconds, rows)
+        for emitter in self.emitters:
+            emitter.emit(model, helper, seconds, rows)
+
+    def snapshot(self):
+        """
+        :return: dict of (model, helper) -> histogram dict
+        """
+        with self._lock:
+            return dict((key, histogram.as_dict()) for key, histogram in self.histograms.items())
+
+    def reset(self):
+        """
+        Clear the histograms and query plans.
+        """
+        with self._lock:
+            self.histograms = {}
+            self.plans = {}
+
+
+def plan_problems(plan):
+    """
+    Find full scans and filesorts in a MySQL EXPLAIN.
+
+    :param plan: list of EXPLAIN rows as dicts
+    :return: list of problem descriptions
+    """
+    problems = []
+    for row in plan:
+        if row.get('type') == 'ALL':
+            problems.append('full scan of {}'.format(row.get('table')))
+        if 'Using filesort' in (row.get('Extra') or ''):
+            problems.append('filesort on {}'.format(row.get('table')))
+    return problems
+
+
+def _explain(engine, statement, parameters):
+    """
+    Run EXPLAIN for a statement on its own connection, so the original statement's cursor is not disturbed.
+
+    :param engine: SQLAlchemy engine
+    :param statement: SQL statement with DBAPI placeholders
+    :param parameters: DBAPI parameters
+    :return: list of EXPLAIN rows as dicts
+    """
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute('EXPLAIN ' + statement, parameters)
+        columns = [description[0] for description in cursor.description]
+        plan = [dict(zip(columns, row)) for row in cursor.fetchall()]
+        cursor.close()
+    finally:
+        connection.close()
+    return plan
+
+
+def instrument(engine, recorder=None, slow_seconds=None, explain=False):
+    """
+    Record latency and rows for every tagged helper query run on an engine.
+
+    :param engine: SQLAlchemy engine, e.g. Flask-SQLAlchemy's db.engine
+    :param recorder: Recorder to collect into, defaults to a new one
+    :param slow_seconds: log a warning for queries slower than this
+    :param explain: run EXPLAIN once per distinct SELECT statement and warn about full scans and filesorts (MySQL only)
+    :return: the Recorder
+    """
+    if recorder is None:
+        recorder = Recorder()
+
+    #
+    # The start time is kept on the statement's execution context, which is dropped with it if the statement fails
+    #
+    @sqlalchemy.event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if context is not None and context.execution_options.get(HELPER_OPTION) is not None:
+            context.jhhalchemy_start = time.time()
+
+    @sqlalchemy.event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        start = getattr(context, 'jhhalchemy_start', None)
+        if start is None:
+            return
+        seconds = time.time() - start
+        helper = context.execution_options[HELPER_OPTION]
+        model = context.execution_options.get(MODEL_OPTION)
+        recorder.record(model, helper, seconds, cursor.rowcount)
+
+        if slow_seconds is not None and seconds > slow_seconds:
+            logger.warning('Slow {}.{} ({:.3f}s): {}'.format(model, helper, seconds, statement))
+
+        if explain and conn.dialect.name == 'mysql' and statement.lstrip().upper().startswith('SELECT') \
+                and statement not in recorder.plans:
+            try:
+                problems = plan_problems(_explain(conn.engine, statement, parameters))
+            except Exception:
+                #
+                # Don't fail the query over its EXPLAIN, e.g. when the pool is exhausted. None keeps it from being
+                # retried for every execution.
+                #
+                logger.exception('Could not EXPLAIN {}.{}: {}'.format(model, helper, statement))
+                recorder.plans[statement] = None
+                return
+            recorder.plans[statement] = problems
+            for problem in problems:
+                logger.warning('{}.{} query plan has a {}: {}'.format(model, helper, problem, statement))
+
+    return recorder
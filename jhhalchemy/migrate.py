@@ -3,11 +3,23 @@ Alembic migration utilities
 """
 import alembic.command
 import alembic.config
+import alembic.ddl.base
+import alembic.operations.ops
+import alembic.runtime.migration
+import alembic.script
+import collections
+import concurrent.futures
 import contextlib
+import jhhalchemy.engine
+import jhhalchemy.model.time_order
 import logging
+import math
 import sqlalchemy
 import sqlalchemy.exc
+import sqlalchemy.ext.compiler
+import sqlalchemy.schema
 import sqlalchemy_utils
+import threading
 import time
 
 #
@@ -15,65 +27,267 @@ import time
 #
 LOCK_TIMEOUT = 5
 
+GET_LOCK = sqlalchemy.text('SELECT GET_LOCK(:name, :timeout)')
+RELEASE_LOCK = sqlalchemy.text('SELECT RELEASE_LOCK(:name)')
+
 logger = logging.getLogger(__name__)
 handler = logging.StreamHandler()
 handler.setFormatter(logging.Formatter(' * JHHAlchemy - %(message)s'))
 logger.addHandler(handler)
 logger.setLevel(logging.INFO)
 
+#
+# MySQL online DDL clause for online_ddl(). MySQL refuses the statement instead of locking the table if the operation
+# can't be done in place without blocking writes.
+#
+ONLINE_ALGORITHM = 'ALGORITHM=INPLACE'
+ONLINE_LOCK = 'LOCK=NONE'
+
+#
+# Default replica lag in seconds ReplicaLagThrottle waits for
+#
+MAX_REPLICA_LAG = 5
+
+#
+# Default seconds ReplicaLagThrottle waits for the replica to catch up before giving up
+#
+MAX_REPLICA_WAIT = 600
+
+_online = threading.local()
+
+
+@contextlib.contextmanager
+def online_ddl():
+    """
+    Compile CREATE INDEX, DROP INDEX and ADD COLUMN statements for MySQL with ALGORITHM=INPLACE, LOCK=NONE in this
+    thread, e.g. for the statements Alembic emits during upgrade(..., online=True).
+    """
+    previous = getattr(_online, 'enabled', False)
+    _online.enabled = True
+    try:
+        yield
+    finally:
+        _online.enabled = previous
+
+
+@sqlalchemy.ext.compiler.compiles(sqlalchemy.schema.CreateIndex, 'mysql')
+def _create_index(element, compiler, **kw):
+    statement = compiler.visit_create_index(element, **kw)
+    if getattr(_online, 'enabled', False):
+        statement = '{} {} {}'.format(statement, ONLINE_ALGORITHM, ONLINE_LOCK)
+    return statement
+
+
+@sqlalchemy.ext.compiler.compiles(sqlalchemy.schema.DropIndex, 'mysql')
+def _drop_index(element, compiler, **kw):
+    statement = compiler.visit_drop_index(element, **kw)
+    if getattr(_online, 'enabled', False):
+        statement = '{} {} {}'.format(statement, ONLINE_ALGORITHM, ONLINE_LOCK)
+    return statement
+
+
+@sqlalchemy.ext.compiler.compiles(alembic.ddl.base.AddColumn, 'mysql')
+def _add_column(element, compiler, **kw):
+    statement = alembic.ddl.base.visit_add_column(element, compiler, **kw)
+    if getattr(_online, 'enabled', False):
+        statement = '{}, {}, {}'.format(statement, ONLINE_ALGORITHM, ONLINE_LOCK)
+    return statement
+
+
+class ReplicationError(Exception):
+    """
+    The replica is not replicating, or did not catch up before the deadline.
+    """
+
+
+class ReplicaLagThrottle(object):
+    """
+    Throttle for upgrade(..., online=True) that waits until a replica has caught up. It is a class rather than a
+    closure so upgrade_many can pickle it into its worker processes.
+    """
+    def __init__(self, connect_str, max_lag_seconds=MAX_REPLICA_LAG, poll_seconds=1, max_wait_seconds=MAX_REPLICA_WAIT):
+        """
+        :param connect_str: connection string to the replica
+        :param max_lag_seconds: continue once Seconds_Behind_Source (Seconds_Behind_Master before MySQL 8.0.22) is at
+            most this
+        :param poll_seconds: how long to wait between checks
+        :param max_wait_seconds: raise ReplicationError if the replica hasn't caught up after this many seconds, None
+            to wait forever
+        """
+        self.connect_str = connect_str
+        self.max_lag_seconds = max_lag_seconds
+        self.poll_seconds = poll_seconds
+        self.max_wait_seconds = max_wait_seconds
+
+    def __call__(self):
+        """
+        Wait until the replica's lag is at most max_lag_seconds.
+
+        :raise ReplicationError: if the lag is NULL (replication stopped or broken) or the replica hasn't caught up
+            after max_wait_seconds
+        """
+        engine = jhhalchemy.engine.get_engine(self.connect_str, 'migration')
+        start = time.time()
+        statement = 'SHOW REPLICA STATUS'
+        while True:
+            try:
+                status = engine.execute(statement).first()
+            except sqlalchemy.exc.ProgrammingError:
+                #
+                # SHOW REPLICA STATUS is new in MySQL 8.0.22, SHOW SLAVE STATUS is gone in 8.4
+                #
+                if statement == 'SHOW SLAVE STATUS':
+                    raise
+                statement = 'SHOW SLAVE STATUS'
+                continue
+            if status is None:
+                logger.warning('{} is not a replica, not throttling'.format(engine.url.database))
+                return
+            #
+            # MariaDB's SHOW REPLICA STATUS keeps the old column name
+            #
+            lag = status['Seconds_Behind_Source'] if 'Seconds_Behind_Source' in status.keys() \
+                else status['Seconds_Behind_Master']
+            if lag is None:
+                raise ReplicationError('Replication on {} is not running'.format(engine.url.database))
+            if lag <= self.max_lag_seconds:
+                return
+            if self.max_wait_seconds is not None and time.time() - start >= self.max_wait_seconds:
+                raise ReplicationError('Replica {} is still {}s behind after {} seconds'.format(
+                    engine.url.database, lag, self.max_wait_seconds))
+            logger.info('Replica lag is {}s, waiting {} seconds'.format(lag, self.poll_seconds))
+            time.sleep(self.poll_seconds)
+
+
+class LockTimeout(Exception):
+    """
+    The upgrade lock could not be acquired before the deadline.
+    """
+
+
 @contextlib.contextmanager
-def get_upgrade_lock(dbname, connect_str, timeout=LOCK_TIMEOUT):
+def get_upgrade_lock(dbname, connect_str, timeout=LOCK_TIMEOUT, deadline=None):
     """
     Wait until you can get the lock, then yield it, and eventually release it.
 
+    The wait blocks inside MySQL's GET_LOCK, which returns as soon as the holder releases the lock, so waiting processes
+    start within milliseconds of the holder finishing. The lock is taken, held and released on one connection that
+    is detached from the shared engine's pool, so closing it really closes the MySQL session. MySQL releases named
+    locks when their session ends, so the lock is never left held on a pooled connection, even if RELEASE_LOCK fails.
+
     Inspired by: http://arr.gr/blog/2016/05/mysql-named-locks-in-python-context-managers/
 
     :param dbname: database to upgrade
     :param connect_str: connection string to the database
-    :param timeout: how long to wait between tries for the lock, default 5 seconds
+    :param timeout: how long each GET_LOCK call blocks before logging progress and checking the deadline, default 5
+        seconds
+    :param deadline: give up with LockTimeout after waiting this many seconds, default wait forever
     """
-    #
-    # Open connection and try to get the lock
-    #
-    engine = sqlalchemy.create_engine(connect_str)
-    cursor = engine.execute("SELECT GET_LOCK('upgrade_{}', {})".format(dbname, timeout))
-    lock = cursor.scalar()
-    cursor.close()
+    name = 'upgrade_{}'.format(dbname)
+    connection = jhhalchemy.engine.get_engine(connect_str, 'migration').connect()
+    connection.detach()
+    try:
+        #
+        # Block in GET_LOCK until we get it or run out of time.
+        #
+        start = time.time()
+        while True:
+            wait = timeout
+            if deadline is not None:
+                remaining = deadline - (time.time() - start)
+                if remaining <= 0:
+                    raise LockTimeout('Could not acquire {} upgrade lock in {} seconds'.format(dbname, deadline))
+                wait = min(timeout, int(math.ceil(remaining)))
+            lock = connection.execute(GET_LOCK, name=name, timeout=wait).scalar()
+            if lock:
+                break
+            logger.info('Waiting for {} upgrade lock, {:.1f} seconds so far'.format(dbname, time.time() - start))
+        logger.info('Acquired {} upgrade lock after {:.3f} seconds'.format(dbname, time.time() - start))
 
-    #
-    # Keep trying until you get it.
-    #
-    while not lock:
-        logger.info('Cannot acquire {} upgrade lock. Sleeping {} seconds.'.format(dbname, timeout))
-        time.sleep(timeout)
-        cursor = engine.execute("SELECT GET_LOCK('upgrade_{}', {})".format(dbname, timeout))
-        lock = cursor.scalar()
-        cursor.close()
-    logger.info('Acquired {} upgrade lock'.format(dbname))
-    yield lock
+        #
+        # Release the lock even if the upgrade fails.
+        #
+        try:
+            yield lock
+        finally:
+            try:
+                connection.execute(RELEASE_LOCK, name=name)
+                logger.info('Released {} upgrade lock'.format(dbname))
+            except sqlalchemy.exc.SQLAlchemyError:
+                #
+                # Drop the session instead, which releases the lock too
+                #
+                logger.exception('Could not release {} upgrade lock, closing its connection'.format(dbname))
+                connection.invalidate()
+    finally:
+        connection.close()
 
-    #
-    # Release the lock and close the connection.
-    #
-    cursor = engine.execute("SELECT RELEASE_LOCK('upgrade_{}')".format(dbname))
-    cursor.close()
-    engine.dispose()
-    logger.info('Released {} upgrade lock'.format(dbname))
+
+#
+# alembic.ini location -> script directory heads, so repeated upgrade() calls only walk the scripts once per process
+#
+_script_heads = {}
 
 
-def upgrade(dbname, connect_str, alembic_conf):
+def get_script_heads(alembic_conf):
+    """
+    Get the head revisions of an Alembic script directory, cached per process.
+
+    :param alembic_conf: location of alembic.ini
+    :return: frozenset of revision ids
+    """
+    heads = _script_heads.get(alembic_conf)
+    if heads is None:
+        alembic_config = alembic.config.Config(alembic_conf, attributes={'configure_logger': False})
+        heads = frozenset(alembic.script.ScriptDirectory.from_config(alembic_config).get_heads())
+        _script_heads[alembic_conf] = heads
+    return heads
+
+
+def get_current_heads(connect_str):
+    """
+    Read the revisions in a database's alembic_version table without taking the upgrade lock.
+
+    :param connect_str: connection string to the database
+    :return: frozenset of revision ids (empty if the table doesn't exist), or None if the database can't be read
     """
-    Get the database's upgrade lock and run alembic.
+    try:
+        with jhhalchemy.engine.get_engine(connect_str, 'migration').connect() as connection:
+            return frozenset(alembic.runtime.migration.MigrationContext.configure(connection).get_current_heads())
+    except sqlalchemy.exc.SQLAlchemyError:
+        return None
+
+
+def upgrade(dbname, connect_str, alembic_conf, online=False, throttle=None, lock_deadline=None, override_url=False):
+    """
+    Get the database's upgrade lock and run alembic. If the database is already at the script heads, return without
+    taking the lock.
 
     :param dbname: Name of the database to upgrade/create
     :param connect_str: Connection string to the database (usually Flask's SQLALCHEMY_DATABASE_URI)
     :param alembic_conf: location of alembic.ini
+    :param online: upgrade one revision at a time with online DDL (see online_ddl), so index and column changes don't
+        block writes on MySQL
+    :param throttle: with online, a function to call before each revision that waits until the database can take more
+        load, e.g. ReplicaLagThrottle(replica_connect_str)
+    :param lock_deadline: raise LockTimeout after waiting this many seconds for the upgrade lock, default wait forever
+    :param override_url: set the Alembic config's sqlalchemy.url to connect_str, so one alembic.ini serves many
+        databases (upgrade_many sets it). By default the URL alembic.ini or env.py sets is used, e.g. for a separate
+        DDL user.
     """
+    start = time.time()
+    heads = get_script_heads(alembic_conf)
+    current = get_current_heads(connect_str)
+    logger.info('Checked {} revision in {:.3f}s'.format(dbname, time.time() - start))
+    if current == heads:
+        logger.info('{} is at head {}'.format(dbname, ', '.join(sorted(heads))))
+        return
+
     #
     # The db has to exist before we can get the lock. On the off-chance that another process creates the db between
     # checking if it exists and running the create, ignore the exception.
     #
-    if not sqlalchemy_utils.database_exists(connect_str):
+    if current is None and not sqlalchemy_utils.database_exists(connect_str):
         logger.info('Creating {}'.format(dbname))
         try:
             sqlalchemy_utils.create_database(connect_str)
@@ -82,9 +296,322 @@ def upgrade(dbname, connect_str, alembic_conf):
                 logger.error('Could not create {}'.format(dbname))
                 raise exc
 
-    with get_upgrade_lock(dbname, connect_str):
+    with get_upgrade_lock(dbname, connect_str, deadline=lock_deadline):
+        start = time.time()
         alembic_config = alembic.config.Config(
             alembic_conf,
             attributes={'configure_logger': False})
-        logger.info('Upgrading {} to head'.format(dbname))
-        alembic.command.upgrade(alembic_config, 'head')
+
+        #
+        # Point env.py's sqlalchemy.url at this database (escaped for ConfigParser interpolation)
+        #
+        if override_url:
+            alembic_config.set_main_option('sqlalchemy.url', connect_str.replace('%', '%%'))
+        if online:
+            _upgrade_online(dbname, connect_str, alembic_config, throttle)
+        else:
+            logger.info('Upgrading {} to head'.format(dbname))
+            alembic.command.upgrade(alembic_config, 'head')
+        logger.info('Upgraded {} in {:.3f}s'.format(dbname, time.time() - start))
+
+
+def _upgrade_online(dbname, connect_str, alembic_config, throttle):
+    """
+    Upgrade to head one revision at a time with online DDL, throttling and logging progress between revisions.
+
+    :param dbname: Name of the database to upgrade
+    :param connect_str: Connection string to the database
+    :param alembic_config: alembic.config.Config
+    :param throttle: function to call before each revision, or None
+    """
+    with jhhalchemy.engine.get_engine(connect_str, 'migration').connect() as connection:
+        current = alembic.runtime.migration.MigrationContext.configure(connection).get_current_revision()
+    script = alembic.script.ScriptDirectory.from_config(alembic_config)
+    revisions = list(reversed(list(script.iterate_revisions('heads', current or 'base'))))
+    logger.info('Upgrading {} from {} to head online, {} revisions'.format(dbname, current, len(revisions)))
+
+    with online_ddl():
+        for i, revision in enumerate(revisions):
+            if throttle is not None:
+                throttle()
+            start = time.time()
+            logger.info('Upgrading {} to {} ({}/{}): {}'.format(
+                dbname, revision.revision, i + 1, len(revisions), revision.doc))
+            alembic.command.upgrade(alembic_config, revision.revision)
+            logger.info('Upgraded {} to {} in {:.1f}s'.format(dbname, revision.revision, time.time() - start))
+
+
+#
+# UpgradeResult statuses. Skipped targets were never started because an earlier target failed with fail_fast.
+#
+UPGRADED = 'upgraded'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+
+#
+# Outcome of one upgrade_many target. error is the exception's type and message, since exceptions from other processes
+# may not unpickle.
+#
+UpgradeResult = collections.namedtuple('UpgradeResult', ['dbname', 'status', 'seconds', 'error'])
+
+
+def _error(exc):
+    """
+    :param exc: exception
+    :return: UpgradeResult error string
+    """
+    return '{}: {}'.format(type(exc).__name__, exc)
+
+
+def _upgrade_target(dbname, connect_str, alembic_conf, kwargs):
+    """
+    Run upgrade for one upgrade_many target in a worker process.
+
+    :param dbname: Name of the database to upgrade/create
+    :param connect_str: Connection string to the database
+    :param alembic_conf: location of alembic.ini
+    :param kwargs: upgrade keyword arguments
+    :return: UpgradeResult
+    """
+    start = time.time()
+    try:
+        upgrade(dbname, connect_str, alembic_conf, **kwargs)
+    except Exception as exc:
+        logger.exception('Could not upgrade {}'.format(dbname))
+        return UpgradeResult(dbname, FAILED, time.time() - start, _error(exc))
+    return UpgradeResult(dbname, UPGRADED, time.time() - start, None)
+
+
+def upgrade_many(targets, alembic_conf, max_workers=4, fail_fast=False, **kwargs):
+    """
+    Upgrade many databases with the same Alembic scripts concurrently, each under its own upgrade lock.
+
+    The upgrades run in a process pool rather than threads because Alembic's context and op proxies are module globals
+    that are not thread-safe. A failed target doesn't stop the others unless fail_fast is set, in which case targets
+    that haven't started yet are skipped (running ones finish). Each target's connect_str overrides the sqlalchemy.url
+    in alembic.ini (see upgrade's override_url).
+
+    :param targets: list of (dbname, connect_str)
+    :param alembic_conf: location of alembic.ini
+    :param max_workers: maximum number of databases to upgrade at once
+    :param fail_fast: skip the remaining targets after the first failure
+    :param kwargs: passed to upgrade, e.g. online, lock_deadline or a picklable throttle such as ReplicaLagThrottle
+    :return: list of UpgradeResult in target order
+    """
+    start = time.time()
+    kwargs['override_url'] = True
+    results = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = collections.OrderedDict(
+            (executor.submit(_upgrade_target, dbname, connect_str, alembic_conf, kwargs), dbname)
+            for dbname, connect_str in targets)
+        for future in concurrent.futures.as_completed(futures):
+            dbname = futures[future]
+            if future.cancelled():
+                result = UpgradeResult(dbname, SKIPPED, 0, None)
+            else:
+                try:
+                    result = future.result()
+                except Exception as exc:
+                    #
+                    # The worker process died (e.g. BrokenProcessPool)
+                    #
+                    result = UpgradeResult(dbname, FAILED, time.time() - start, _error(exc))
+            results[future] = result
+            if result.status == FAILED and fail_fast:
+                for pending in futures:
+                    pending.cancel()
+    results = [results[future] for future in futures]
+
+    #
+    # Summary report
+    #
+    counts = collections.Counter(result.status for result in results)
+    logger.info('Upgraded {} of {} databases in {:.1f}s: {} failed, {} skipped'.format(
+        counts[UPGRADED], len(results), time.time() - start, counts[FAILED], counts[SKIPPED]))
+    for result in results:
+        logger.info('  {} {} {:.1f}s{}'.format(
+            result.dbname, result.status, result.seconds, ' ' + result.error if result.error else ''))
+    return results
+
+
+def missing_indexes(connect_str, metadata):
+    """
+    Find the indexes declared in the models (e.g., with __soft_delete_index__ or __time_order_index__) that the live
+    schema does not have. An existing index or primary key whose leading columns match counts as a match. Tables that
+    don't exist yet are skipped.
+
+    :param connect_str: connection string to the database
+    :param metadata: sqlalchemy.MetaData with the model tables (usually Flask-SQLAlchemy's db.metadata)
+    :return: list of missing sqlalchemy.Index objects
+    """
+    inspector = sqlalchemy.inspect(jhhalchemy.engine.get_engine(connect_str, 'migration'))
+    tables = set(inspector.get_table_names())
+    missing = []
+    for table in metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        live = [tuple(index['column_names']) for index in inspector.get_indexes(table.name)]
+        live.append(tuple(inspector.get_pk_constraint(table.name)['constrained_columns']))
+        for index in table.indexes:
+            columns = tuple(column.name for column in index.columns)
+            if not any(existing[:len(columns)] == columns for existing in live):
+                logger.warning('{} is missing index {} on ({})'.format(table.name, index.name, ', '.join(columns)))
+                missing.append(index)
+    return missing
+
+
+def missing_index_ops(connect_str, metadata):
+    """
+    Build the Alembic operations that create the missing indexes. To get the code for a migration script, pass the
+    result to alembic.autogenerate.render_python_code.
+
+    :param connect_str: connection string to the database
+    :param metadata: sqlalchemy.MetaData with the model tables
+    :return: alembic UpgradeOps with one create_index operation per missing index
+    """
+    indexes = missing_indexes(connect_str, metadata)
+    return alembic.operations.ops.UpgradeOps(
+        ops=[alembic.operations.ops.CreateIndexOp.from_index(index) for index in indexes])
+
+
+def _partition_definition(boundary):
+    """
+    :param boundary: oldest timestamp in the partition, or None for the catch-all partition of older rows
+    :return: partition definition SQL
+    """
+    if boundary is None:
+        return 'PARTITION {} VALUES LESS THAN MAXVALUE'.format(jhhalchemy.model.time_order.OLD_PARTITION)
+    #
+    # time_order is the negated timestamp, so the partition holds time_order <= -boundary
+    #
+    return 'PARTITION p{} VALUES LESS THAN ({})'.format(boundary, -boundary + 1)
+
+
+def get_partitions(connect_str, table_name):
+    """
+    Get a time_order partitioned table's partitions, newest first. A partition holds the rows from its boundary up to
+    the previous partition's boundary.
+
+    :param connect_str: connection string to the database
+    :param table_name: table name
+    :return: list of (partition name, boundary timestamp) pairs, the last boundary is None for the catch-all partition.
+        Empty if the table is not partitioned.
+    """
+    rows = jhhalchemy.engine.get_engine(connect_str, 'migration').execute(
+        sqlalchemy.text(
+            'SELECT PARTITION_NAME, PARTITION_DESCRIPTION FROM information_schema.PARTITIONS '
+            'WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table_name AND PARTITION_NAME IS NOT NULL '
+            'ORDER BY PARTITION_ORDINAL_POSITION'),
+        table_name=table_name).fetchall()
+    return [(name, None if description == 'MAXVALUE' else 1 - int(description)) for name, description in rows]
+
+
+def _alter_partitions(connect_str, table_name, clause):
+    """
+    Run ALTER TABLE <table_name> <clause>.
+
+    :param connect_str: connection string to the database
+    :param table_name: table name
+    :param clause: partition clause
+    """
+    engine = jhhalchemy.engine.get_engine(connect_str, 'migration')
+    statement = 'ALTER TABLE {} {}'.format(engine.dialect.identifier_preparer.quote(table_name), clause)
+    logger.info(statement)
+    engine.execute(statement)
+
+
+def create_partitions(connect_str, table_name, boundaries):
+    """
+    Partition an existing table on time_order. This rebuilds the table, so for large tables run it off-peak or with
+    an online schema change tool. Tables of models with __time_order_partitioned__ are created partitioned.
+
+    :param connect_str: connection string to the database
+    :param table_name: table name
+    :param boundaries: partition boundary timestamps, each partition holds the rows from its boundary to the next one
+    """
+    definitions = [_partition_definition(boundary) for boundary in sorted(set(boundaries), reverse=True)]
+    definitions.append(_partition_definition(None))
+    _alter_partitions(
+        connect_str, table_name, 'PARTITION BY RANGE (time_order) ({})'.format(', '.join(definitions)))
+
+
+def roll_partitions(connect_str, table_name, interval, ahead=2, now=None):
+    """
+    Add partitions so that the next `ahead` intervals each have an empty partition ready before rows arrive. New
+    partitions are split off the newest partition, which only holds future rows once the table has been rolled, so
+    the split is cheap. Run it on a schedule more often than the interval.
+
+    :param connect_str: connection string to the database
+    :param table_name: time_order partitioned table name
+    :param interval: partition width in seconds, boundaries are multiples of it
+    :param ahead: number of future intervals to keep partitions for
+    :param now: current unix timestamp, defaults to time.time()
+    :return: list of added boundary timestamps
+    """
+    partitions = get_partitions(connect_str, table_name)
+    if not partitions:
+        raise ValueError('{} is not partitioned'.format(table_name))
+    current = int((time.time() if now is None else now) // interval * interval)
+    first_name, first_boundary = partitions[0]
+    start = current if first_boundary is None else first_boundary + interval
+    added = list(range(start, current + (ahead + 1) * interval, interval))
+    if not added:
+        return added
+
+    definitions = [_partition_definition(boundary) for boundary in reversed(added)]
+    definitions.append(_partition_definition(first_boundary))
+    _alter_partitions(
+        connect_str, table_name, 'REORGANIZE PARTITION {} INTO ({})'.format(first_name, ', '.join(definitions)))
+    return added
+
+
+def drop_partitions(connect_str, table_name, before_timestamp):
+    """
+    Drop the partitions that only hold rows older than before_timestamp. This is much faster than deleting the rows
+    and frees their space right away. The catch-all partition of older rows is truncated instead of dropped.
+
+    :param connect_str: connection string to the database
+    :param table_name: time_order partitioned table name
+    :param before_timestamp: unix timestamp, rows before it may be dropped
+    :return: list of dropped or truncated partition names
+    """
+    partitions = get_partitions(connect_str, table_name)
+    dropped = []
+    truncated = []
+    for (_, newer_boundary), (name, boundary) in zip(partitions, partitions[1:]):
+        if newer_boundary > before_timestamp:
+            continue
+        if boundary is None:
+            truncated.append(name)
+        else:
+            dropped.append(name)
+    if dropped:
+        _alter_partitions(connect_str, table_name, 'DROP PARTITION {}'.format(', '.join(dropped)))
+    if truncated:
+        _alter_partitions(connect_str, table_name, 'TRUNCATE PARTITION {}'.format(', '.join(truncated)))
+    return dropped + truncated
+
+
+def explain_partitions(query):
+    """
+    Check which partitions a query reads, e.g. to verify that a read_time_range query prunes partitions.
+
+    :param query: SQLAlchemy Query
+    :return: dict of table name -> list of partition names the query reads
+    """
+    bind = query.session.get_bind()
+    statement = str(query.statement.compile(dialect=bind.dialect, compile_kwargs={'literal_binds': True}))
+    try:
+        result = bind.execute('EXPLAIN PARTITIONS ' + statement)
+    except sqlalchemy.exc.ProgrammingError:
+        #
+        # MySQL 8 dropped EXPLAIN PARTITIONS, its EXPLAIN always has the partitions column
+        #
+        result = bind.execute('EXPLAIN ' + statement)
+    partitions = {}
+    for row in result:
+        row = dict(row.items())
+        if row.get('partitions'):
+            partitions.setdefault(row['table'], []).extend(row['partitions'].split(','))
+    return partitions
@@ -1,8 +1,16 @@
 """
 Define the flask_sqlalchemy base model for JHH.
 """
+import collections
+import contextlib
 import flask_sqlalchemy
+import itertools
+import jhhalchemy.instrument
+import numbers
 import sqlalchemy
+import sqlalchemy.dialects.mysql
+import threading
+import time
 
 
 #
@@ -10,6 +18,121 @@ import sqlalchemy
 #
 NOT_REMOVED = 0
 
+#
+# Default number of rows per statement/commit for the bulk helpers
+#
+CHUNK_SIZE = 1000
+
+#
+# Models with __archive__ get an archive table named <table><ARCHIVE_SUFFIX>
+#
+ARCHIVE_SUFFIX = '_archive'
+
+#
+# Timing for one chunk of a bulk write
+#
+ChunkResult = collections.namedtuple('ChunkResult', ['rows', 'rowcount', 'seconds'])
+
+_session = threading.local()
+
+
+@contextlib.contextmanager
+def using_session(session):
+    """
+    Build the read helpers' queries from a session in this thread instead of flask_sqlalchemy's Model.query, e.g. a
+    shard's session, which also works outside a Flask app context.
+
+    :param session: SQLAlchemy session
+    """
+    previous = getattr(_session, 'session', None)
+    _session.session = session
+    try:
+        yield
+    finally:
+        _session.session = previous
+
+
+def _chunks(iterable, size):
+    """
+    Split an iterable into lists of at most size items without materializing the whole iterable.
+
+    :param iterable: any iterable (list, generator, query, etc.)
+    :param size: maximum number of items per chunk
+    :return: list generator
+    """
+    iterator = iter(iterable)
+    chunk = list(itertools.islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(itertools.islice(iterator, size))
+
+
+def _identity(pk):
+    """
+    Normalize a primary key value to the tuple form SQLAlchemy uses for identities.
+
+    :param pk: primary key value, or tuple of values for composite keys
+    :return: tuple of primary key values
+    """
+    return tuple(pk) if isinstance(pk, (tuple, list)) else (pk,)
+
+
+def _after_key(columns, values):
+    """
+    Build the condition for rows after a primary key in key order, i.e. (columns) > (values). Composite keys are
+    expanded into ORs of ANDs rather than a row comparison so that MySQL can use it as an index range.
+
+    :param columns: primary key columns
+    :param values: primary key value, or tuple of values for composite keys
+    :return: SQLAlchemy criterion
+    """
+    values = _identity(values)
+    if len(columns) == 1:
+        return columns[0] > values[0]
+    return sqlalchemy.or_(*[
+        sqlalchemy.and_(*[columns[j] == values[j] for j in range(i)] + [columns[i] > values[i]])
+        for i in range(len(columns))])
+
+
+def _in_batch(columns, batch):
+    """
+    Build the conditions for the rows of one _primary_key_batches batch. Single column keys are bounded by the
+    batch's key range, composite keys by the batch's keys, so a statement never covers more rows than the batch.
+
+    :param columns: primary key columns
+    :param batch: ascending primary key values, or tuples of values for composite keys
+    :return: list of SQLAlchemy criteria
+    """
+    if len(columns) == 1:
+        return [columns[0] >= batch[0], columns[0] <= batch[-1]]
+    return [sqlalchemy.tuple_(*columns).in_(batch)]
+
+
+def _removed(model):
+    """
+    Check a loaded model for soft-deletion. A pending soft-delete (time_removed set to an SQL expression but not yet
+    flushed) counts as removed.
+
+    :param model: model instance
+    :return: whether the model is soft-deleted
+    """
+    if isinstance(model.time_removed, numbers.Integral):
+        return model.time_removed != NOT_REMOVED
+    return True
+
+
+def _declare_index(table, suffix, columns):
+    """
+    Add an index named ix_<table>_<suffix> to a table unless the table already has it.
+
+    :param table: sqlalchemy.Table
+    :param suffix: index name suffix
+    :param columns: names of the indexed columns, in order
+    """
+    name = 'ix_{}_{}'.format(table.name, suffix)
+    if name not in set(index.name for index in table.indexes):
+        sqlalchemy.Index(name, *[table.c[column] for column in columns])
+
 
 class Base(flask_sqlalchemy.Model):
     """
@@ -19,6 +142,28 @@ class Base(flask_sqlalchemy.Model):
     __abstract__ = True
     __table_args__ = {'mysql_engine': 'InnoDB'}
 
+    #
+    # Set to a jhhalchemy.model.cache.ModelCache to enable read_cached and read_by_cached caching for a model class
+    #
+    __cache__ = None
+
+    #
+    # Set to a jhhalchemy.model.changes.ChangeStream to capture save and delete events for a model class
+    #
+    __changes__ = None
+
+    #
+    # Set to a tuple of column names to declare an index on (<columns>, time_removed) for read and read_by queries
+    #
+    __soft_delete_index__ = None
+
+    #
+    # Set to True to declare a <table>_archive table with the same columns for jhhalchemy.model.archive to move
+    # soft-deleted and aged rows to. The table is available as __archive_table__ once the class is mapped.
+    #
+    __archive__ = False
+    __archive_table__ = None
+
     time_removed = sqlalchemy.Column(sqlalchemy.Integer, nullable=False, server_default='{}'.format(NOT_REMOVED))
     time_created = sqlalchemy.Column(
         sqlalchemy.Integer,
@@ -30,6 +175,14 @@ class Base(flask_sqlalchemy.Model):
         server_onupdate=sqlalchemy.func.now(),
         server_default=sqlalchemy.text('CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP'))
 
+    @classmethod
+    def _query(cls):
+        """
+        :return: query on the model from the session of the enclosing using_session block, or else Model.query
+        """
+        session = getattr(_session, 'session', None)
+        return cls.query if session is None else session.query(cls)
+
     def save(self, session, commit=True):
         """
         Add a row to the session so that it gets saved to the DB.
@@ -37,9 +190,126 @@ class Base(flask_sqlalchemy.Model):
         :param session: flask_sqlalchemy session object
         :param commit: whether to issue the commit
         """
+        if self.__changes__ is not None:
+            self.__changes__.track_save(session, self)
         session.add(self)
         if commit:
             session.commit()
+        if self.__cache__ is not None:
+            self.__cache__.invalidate_model(self, session=None if commit else session)
+
+    @classmethod
+    def save_many(cls, session, rows, chunk_size=CHUNK_SIZE, upsert=False, commit=True):
+        """
+        Bulk insert rows with one executemany INSERT and one commit per chunk.
+
+        Leave time_created and time_removed out of the row dicts so that the server defaults apply. All rows in a
+        chunk must have the same keys.
+
+        With upsert, the MySQL INSERT ... ON DUPLICATE KEY UPDATE form is used. Every non-primary key column in the
+        row dicts is updated with the new value, except time_created, which keeps the original insert time.
+
+        :param session: flask_sqlalchemy session object
+        :param rows: iterable of dicts mapping column names to values
+        :param chunk_size: number of rows per INSERT statement and commit
+        :param upsert: whether to update existing rows on duplicate keys (MySQL only)
+        :param commit: whether to issue a commit after each chunk
+        :return: list of ChunkResult(rows, rowcount, seconds), one per chunk
+        """
+        results = []
+        for chunk in _chunks(rows, chunk_size):
+            start = time.time()
+            if upsert:
+                stmt = sqlalchemy.dialects.mysql.insert(cls.__table__)
+                primary_keys = [column.key for column in cls.__table__.primary_key.columns]
+                updates = dict(
+                    (key, stmt.inserted[key]) for key in chunk[0]
+                    if key not in primary_keys and key != 'time_created')
+
+                #
+                # Only keys were given, so make the update a no-op instead of failing on the duplicate.
+                #
+                if not updates:
+                    updates = {primary_keys[0]: stmt.inserted[primary_keys[0]]}
+                stmt = stmt.on_duplicate_key_update(**updates)
+            else:
+                stmt = cls.__table__.insert()
+            result = session.execute(stmt, chunk)
+            if commit:
+                session.commit()
+            if cls.__cache__ is not None:
+                keys = [column.key for column in cls.__table__.primary_key.columns]
+                cls.__cache__.invalidate(
+                    cls, [tuple(row[key] for key in keys) for row in chunk if all(key in row for key in keys)],
+                    session=None if commit else session)
+            results.append(ChunkResult(len(chunk), result.rowcount, time.time() - start))
+        return results
+
+    @classmethod
+    def _primary_key_batches(cls, session, criteria, batch_size):
+        """
+        Walk the primary keys of the rows that match the criteria in ascending order, one batch at a time. Each batch
+        is selected after the caller is done with the previous one, so rows the caller changed are not revisited.
+
+        :param session: flask_sqlalchemy session object
+        :param criteria: list of where clause conditions
+        :param batch_size: maximum number of keys per batch
+        :return: generator of ascending primary key lists, with a tuple per key for composite keys
+        """
+        primary_key = list(cls.__mapper__.primary_key)
+        last = None
+        while True:
+            query = session.query(*primary_key).filter(*criteria)
+            if last is not None:
+                query = query.filter(_after_key(primary_key, last))
+            batch = [
+                row[0] if len(primary_key) == 1 else tuple(row)
+                for row in query.order_by(*primary_key).limit(batch_size)]
+            if not batch:
+                return
+            yield batch
+            if len(batch) < batch_size:
+                return
+            last = batch[-1]
+
+    @classmethod
+    def delete_where(cls, session, *criteria, **kwargs):
+        """
+        Delete all rows matching the criteria in SQL without loading them.
+
+        The matching primary keys are walked in batches and each UPDATE/DELETE is bounded by the batch's primary key
+        range (or, for composite keys, the batch's keys), so no statement holds locks on more than batch_size rows.
+        Soft deletes skip rows that are already soft-deleted, so it is safe to rerun after a failure.
+
+        :param session: flask_sqlalchemy session object
+        :param criteria: where clause conditions
+        :param kwargs: soft (default True), batch_size (default CHUNK_SIZE) and commit (default True, once per batch)
+        :return: number of rows deleted
+        """
+        soft = kwargs.get('soft', True)
+        batch_size = kwargs.get('batch_size', CHUNK_SIZE)
+        commit = kwargs.get('commit', True)
+
+        criteria = list(criteria)
+        if soft:
+            criteria.append(cls.time_removed == NOT_REMOVED)
+
+        primary_key = list(cls.__mapper__.primary_key)
+        count = 0
+        for batch in cls._primary_key_batches(session, criteria, batch_size):
+            query = session.query(cls).filter(*_in_batch(primary_key, batch) + criteria)
+            if soft:
+                count += query.update(
+                    {cls.time_removed: sqlalchemy.func.unix_timestamp()},
+                    synchronize_session=False)
+            else:
+                count += query.delete(synchronize_session=False)
+            if commit:
+                session.commit()
+            if cls.__cache__ is not None:
+                cls.__cache__.invalidate(
+                    cls, [_identity(key) for key in batch], session=None if commit else session)
+        return count
 
     @classmethod
     def read_by(cls, removed=False, **kwargs):
@@ -52,7 +322,7 @@ class Base(flask_sqlalchemy.Model):
         """
         if not removed:
             kwargs['time_removed'] = 0
-        return cls.query.filter_by(**kwargs)
+        return jhhalchemy.instrument.tag(cls._query().filter_by(**kwargs), cls, 'read_by')
 
     @classmethod
     def read(cls, *criteria, **kwargs):
@@ -61,12 +331,128 @@ class Base(flask_sqlalchemy.Model):
         consider using read_by.
 
         :param criteria: where clause conditions
-        :param kwargs: set removed=True if you want soft-deleted rows
+        :param kwargs: set removed=True if you want soft-deleted rows, archived=True to include the archive table's rows
         :return: row object generator
         """
         if not kwargs.get('removed', False):
-            return cls.query.filter(cls.time_removed == 0, *criteria)
-        return cls.query.filter(*criteria)
+            criteria = (cls.time_removed == 0,) + criteria
+        if kwargs.get('archived', False):
+            union = cls._archive_union(criteria)
+            query = cls._query().select_entity_from(union)
+        else:
+            query = cls._query().filter(*criteria)
+        return jhhalchemy.instrument.tag(query, cls, 'read')
+
+    @classmethod
+    def _archive_union(cls, criteria):
+        """
+        Select the rows matching the criteria from both the table and its archive table. The criteria are applied
+        inside each half of the UNION so both can use their indexes.
+
+        :param criteria: where clause conditions on the model's columns
+        :return: aliased UNION ALL to select the model from
+        """
+        table = cls.__table__
+        archive = cls.__archive_table__
+        if archive is None:
+            raise ValueError('{} has no archive table, set __archive__ = True'.format(cls.__name__))
+
+        def to_archive(element):
+            if isinstance(element, sqlalchemy.Column) and element.table is table:
+                return archive.c[element.key]
+            return None
+
+        archived_criteria = [
+            sqlalchemy.sql.visitors.replacement_traverse(criterion, {}, to_archive) for criterion in criteria]
+        return sqlalchemy.union_all(
+            sqlalchemy.select([table]).where(sqlalchemy.and_(*criteria)),
+            sqlalchemy.select([archive.c[column.key] for column in table.columns]).where(
+                sqlalchemy.and_(*archived_criteria))).alias('{}_all'.format(table.name))
+
+    @classmethod
+    def get(cls, pk, removed=False):
+        """
+        Primary key lookup. Rows already in the session's identity map are returned without a query, and the
+        soft-delete logic is applied to them in Python.
+
+        :param pk: primary key value, or tuple of values for composite keys
+        :param removed: whether to return a soft-deleted row
+        :return: model instance or None
+        """
+        model = cls._query().get(pk)
+        if model is None or (not removed and _removed(model)):
+            return None
+        return model
+
+    @classmethod
+    def get_many(cls, pks, removed=False, chunk_size=CHUNK_SIZE):
+        """
+        Batch primary key lookup. Rows already loaded in the session's identity map are used as is, the rest (including
+        instances expired by a commit) are loaded with one IN query per chunk.
+
+        :param pks: primary key values, or tuples of values for composite keys
+        :param removed: whether to return soft-deleted rows
+        :param chunk_size: maximum number of keys per IN query
+        :return: OrderedDict of primary key -> model instance, in the order of pks, without keys that were not found
+        """
+        query = cls._query()
+        mapper = cls.__mapper__
+        found = {}
+        missing = []
+        for pk in pks:
+            model = query.session.identity_map.get(mapper.identity_key_from_primary_key(_identity(pk)))
+            if model is None or 'time_removed' in sqlalchemy.inspect(model).unloaded:
+                #
+                # Not in the session, or expired: checking time_removed would load it with a query per row
+                #
+                missing.append(pk)
+            elif removed or not _removed(model):
+                found[pk] = model
+
+        if len(mapper.primary_key) == 1:
+            columns = mapper.primary_key[0]
+        else:
+            columns = sqlalchemy.tuple_(*mapper.primary_key)
+        for chunk in _chunks(missing, chunk_size):
+            for model in cls.read(columns.in_(chunk), removed=removed):
+                pk = tuple(mapper.primary_key_from_instance(model))
+                found[pk[0] if len(pk) == 1 else pk] = model
+
+        return collections.OrderedDict((pk, found[pk]) for pk in pks if pk in found)
+
+    @classmethod
+    def read_cached(cls, pk, removed=False):
+        """
+        Primary key lookup through the model's __cache__, if it has one.
+
+        :param pk: primary key value, or tuple of values for composite keys
+        :param removed: whether to return a soft-deleted row
+        :return: model instance (detached on a cache hit) or None
+        """
+        if cls.__cache__ is None:
+            return cls.get(pk, removed=removed)
+        model = cls.__cache__.get(cls, pk, lambda: cls.get(pk, removed=True), session=cls._query().session)
+        if model is None or (not removed and _removed(model)):
+            return None
+        return model
+
+    @classmethod
+    def read_by_cached(cls, removed=False, **kwargs):
+        """
+        read_by through the model's __cache__, if it has one. Results are cached per set of keyword arguments until
+        the next save or delete of the model class.
+
+        :param removed: whether to include soft-deleted rows
+        :param kwargs: where clause mappings to pass to filter_by
+        :return: list of model instances (detached on a cache hit)
+        """
+        if cls.__cache__ is None:
+            return cls.read_by(removed=removed, **kwargs).all()
+        return cls.__cache__.query(
+            cls,
+            dict(kwargs, removed=removed),
+            lambda: cls.read_by(removed=removed, **kwargs).all(),
+            session=cls._query().session)
 
     def delete(self, session, commit=True, soft=True):
         """
@@ -76,6 +462,8 @@ class Base(flask_sqlalchemy.Model):
         :param commit: whether to issue the commit
         :param soft: whether this is a soft delete (i.e., update time_removed)
         """
+        if self.__changes__ is not None:
+            self.__changes__.track_delete(session, self, soft)
         if soft:
             self.time_removed = sqlalchemy.func.unix_timestamp()
         else:
@@ -83,3 +471,41 @@ class Base(flask_sqlalchemy.Model):
 
         if commit:
             session.commit()
+        if self.__cache__ is not None:
+            self.__cache__.invalidate_model(self, session=None if commit else session)
+
+
+@sqlalchemy.event.listens_for(Base, 'instrument_class', propagate=True)
+def _declare_soft_delete_index(mapper, cls):
+    """
+    Declare the __soft_delete_index__ index when a model class is mapped.
+
+    :param mapper: the model's mapper
+    :param cls: model class
+    """
+    if cls.__soft_delete_index__ and mapper.local_table is not None:
+        _declare_index(mapper.local_table, 'soft_delete', tuple(cls.__soft_delete_index__) + ('time_removed',))
+
+
+@sqlalchemy.event.listens_for(Base, 'instrument_class', propagate=True)
+def _declare_archive_table(mapper, cls):
+    """
+    Declare the __archive__ table when a model class is mapped. It has the same columns and primary key, without
+    autoincrement since rows keep their keys when they are archived.
+
+    :param mapper: the model's mapper
+    :param cls: model class
+    """
+    table = mapper.local_table
+    if not cls.__archive__ or table is None:
+        return
+    name = table.name + ARCHIVE_SUFFIX
+    archive = table.metadata.tables.get(name)
+    if archive is None:
+        columns = []
+        for column in table.columns:
+            column = column.copy()
+            column.autoincrement = False
+            columns.append(column)
+        archive = sqlalchemy.Table(name, table.metadata, *columns, **table.kwargs)
+    cls.__archive_table__ = archive
@@ -0,0 +1,189 @@
+"""
+asyncio versions of the Base and TimeOrderMixin helpers for SQLAlchemy's AsyncSession. Requires Python 3 and
+SQLAlchemy 1.4 or later, i.e. the aio extra (pip install jhhalchemy[aio]).
+
+The helpers take the session and model class explicitly instead of using flask_sqlalchemy's cls.query, and keep the
+same soft-delete and time_order semantics, so one model definition serves both Flask apps and asyncio workers:
+
+session = sqlalchemy.ext.asyncio.AsyncSession(engine, expire_on_commit=False)
+await jhhalchemy.model.aio.save(session, my_model)
+my_models = await jhhalchemy.model.aio.get_by_range(session, MyModel, MyModel.uid == uid, start_timestamp=start)
+
+The *_statement functions return the tagged SELECT for callers that need to add to it before executing.
+"""
+import jhhalchemy.instrument
+import jhhalchemy.model
+import jhhalchemy.model.time_order
+import sqlalchemy
+
+try:
+    import sqlalchemy.ext.asyncio
+except ImportError:
+    raise ImportError('jhhalchemy.model.aio requires SQLAlchemy 1.4 or later')
+
+
+async def save(session, model, commit=True):
+    """
+    Add a row to the session so that it gets saved to the DB.
+
+    :param session: sqlalchemy.ext.asyncio.AsyncSession
+    :param model: model instance
+    :param commit: whether to issue the commit
+    """
+    if model.__changes__ is not None:
+        model.__changes__.track_save(session.sync_session, model)
+    session.add(model)
+    if commit:
+        await session.commit()
+    if model.__cache__ is not None:
+        model.__cache__.invalidate_model(model, session=None if commit else session.sync_session)
+
+
+async def delete(session, model, commit=True, soft=True):
+    """
+    Delete a row from the DB.
+
+    :param session: sqlalchemy.ext.asyncio.AsyncSession
+    :param model: model instance
+    :param commit: whether to issue the commit
+    :param soft: whether this is a soft delete (i.e., update time_removed)
+    """
+    if model.__changes__ is not None:
+        model.__changes__.track_delete(session.sync_session, model, soft)
+    if soft:
+        model.time_removed = sqlalchemy.func.unix_timestamp()
+    else:
+        await session.delete(model)
+
+    if commit:
+        await session.commit()
+    if model.__cache__ is not None:
+        model.__cache__.invalidate_model(model, session=None if commit else session.sync_session)
+
+
+def read_by_statement(model_cls, removed=False, **kwargs):
+    """
+    Build the SELECT for read_by.
+
+    :param model_cls: the class of the model
+    :param removed: whether to include soft-deleted rows
+    :param kwargs: where clause mappings to pass to filter_by
+    :return: tagged sqlalchemy Select
+    """
+    if not removed:
+        kwargs['time_removed'] = jhhalchemy.model.NOT_REMOVED
+    return jhhalchemy.instrument.tag(sqlalchemy.select(model_cls).filter_by(**kwargs), model_cls, 'read_by')
+
+
+def read_statement(model_cls, *criteria, **kwargs):
+    """
+    Build the SELECT for read.
+
+    :param model_cls: the class of the model
+    :param criteria: where clause conditions
+    :param kwargs: set removed=True if you want soft-deleted rows
+    :return: tagged sqlalchemy Select
+    """
+    if not kwargs.get('removed', False):
+        criteria = (model_cls.time_removed == jhhalchemy.model.NOT_REMOVED,) + criteria
+    return jhhalchemy.instrument.tag(sqlalchemy.select(model_cls).where(*criteria), model_cls, 'read')
+
+
+def read_time_range_statement(model_cls, *args, **kwargs):
+    """
+    Build the SELECT for read_time_range.
+
+    :param model_cls: the class of the model, must use TimeOrderMixin
+    :param args: where clause conditions
+    :param kwargs: start_timestamp, end_timestamp and removed
+    :return: tagged sqlalchemy Select
+    """
+    criteria = list(args) + model_cls.time_range_criteria(kwargs.get('start_timestamp'), kwargs.get('end_timestamp'))
+    return jhhalchemy.instrument.tag(
+        read_statement(model_cls, *criteria, removed=kwargs.get('removed', False)), helper='read_time_range')
+
+
+def get_by_range_statement(model_cls, *args, **kwargs):
+    """
+    Build the SELECT for get_by_range.
+
+    :param model_cls: the class of the model, must use TimeOrderMixin
+    :param args: where clause conditions
+    :param kwargs: start_timestamp, end_timestamp, asc and removed
+    :return: tagged sqlalchemy Select
+    """
+    start_timestamp = kwargs.get('start_timestamp')
+    end_timestamp = kwargs.get('end_timestamp')
+    jhhalchemy.model.time_order._check_range(start_timestamp, end_timestamp)
+
+    statement = read_time_range_statement(
+        model_cls,
+        *args,
+        start_timestamp=start_timestamp,
+        end_timestamp=end_timestamp,
+        removed=kwargs.get('removed', False))
+    order = jhhalchemy.model.time_order._range_order(model_cls, kwargs.get('asc'))
+    return jhhalchemy.instrument.tag(statement.order_by(order), helper='get_by_range')
+
+
+async def _all(session, statement):
+    """
+    :param session: sqlalchemy.ext.asyncio.AsyncSession
+    :param statement: Select of one model class
+    :return: list of models
+    """
+    result = await session.execute(statement)
+    return result.scalars().all()
+
+
+async def read_by(session, model_cls, removed=False, **kwargs):
+    """
+    filter_by helper that handles soft delete logic.
+
+    :param session: sqlalchemy.ext.asyncio.AsyncSession
+    :param model_cls: the class of the model
+    :param removed: whether to include soft-deleted rows
+    :param kwargs: where clause mappings to pass to filter_by
+    :return: list of models
+    """
+    return await _all(session, read_by_statement(model_cls, removed=removed, **kwargs))
+
+
+async def read(session, model_cls, *criteria, **kwargs):
+    """
+    filter helper that handles soft delete logic.
+
+    :param session: sqlalchemy.ext.asyncio.AsyncSession
+    :param model_cls: the class of the model
+    :param criteria: where clause conditions
+    :param kwargs: set removed=True if you want soft-deleted rows
+    :return: list of models
+    """
+    return await _all(session, read_statement(model_cls, *criteria, **kwargs))
+
+
+async def read_time_range(session, model_cls, *args, **kwargs):
+    """
+    Read the models in an inclusive time range.
+
+    :param session: sqlalchemy.ext.asyncio.AsyncSession
+    :param model_cls: the class of the model, must use TimeOrderMixin
+    :param args: where clause conditions
+    :param kwargs: start_timestamp, end_timestamp and removed
+    :return: list of models
+    """
+    return await _all(session, read_time_range_statement(model_cls, *args, **kwargs))
+
+
+async def get_by_range(session, model_cls, *args, **kwargs):
+    """
+    Get ordered list of models for the specified time range. The timestamp on the earliest model will likely occur
+    before start_timestamp. This is to ensure that we return the models for the entire range.
+
+    :param session: sqlalchemy.ext.asyncio.AsyncSession
+    :param model_cls: the class of the model, must use TimeOrderMixin
+    :param args: where clause conditions
+    :param kwargs: start_timestamp, end_timestamp, asc and removed
+    :return: list of models
+    """
+    return await _all(session, get_by_range_statement(model_cls, *args, **kwargs))
@@ -0,0 +1,156 @@
+"""
+Move soft-deleted and aged rows out of hot tables into their archive tables.
+
+Enable it per model class by setting __archive__, then run archive() on a schedule:
+
+class MyModel(db.Model):
+    __archive__ = True
+
+jhhalchemy.model.archive.archive(db.session, MyModel, removed_before=time.time() - 30 * 86400)
+
+Archived rows are still returned by MyModel.read(..., removed=True, archived=True).
+"""
+import collections
+import jhhalchemy.model
+import json
+import logging
+import os
+import sqlalchemy
+import time
+
+logger = logging.getLogger(__name__)
+
+#
+# Totals for one archive() run. In a dry run, rows is the number of rows that would have been moved.
+#
+ArchiveResult = collections.namedtuple('ArchiveResult', ['rows', 'batches', 'seconds'])
+
+
+class FileCheckpoint(object):
+    """
+    Keep an archive() run's progress in a JSON file so an interrupted run resumes where it stopped.
+
+    This is also the checkpoint interface: load() returns the saved value or None, save(value) and clear(). To keep
+    checkpoints elsewhere (e.g., a DB row or redis), pass an object with those three methods.
+    """
+    def __init__(self, path):
+        """
+        :param path: checkpoint file path
+        """
+        self.path = path
+
+    def load(self):
+        """
+        :return: the saved value, or None if there is no checkpoint
+        """
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path) as checkpoint_file:
+            return json.load(checkpoint_file)
+
+    def save(self, value):
+        """
+        Write the value to a temporary file and rename it, so the checkpoint is never half written.
+
+        :param value: JSON serializable value
+        """
+        temporary = self.path + '.tmp'
+        with open(temporary, 'w') as checkpoint_file:
+            json.dump(value, checkpoint_file)
+        os.rename(temporary, self.path)
+
+    def clear(self):
+        """
+        Remove the checkpoint.
+        """
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def archive_criterion(model_cls, removed_before=None, older_than=None):
+    """
+    Build the condition for the rows to archive.
+
+    :param model_cls: the class of the model
+    :param removed_before: archive rows soft-deleted before this unix timestamp
+    :param older_than: archive TimeOrder rows with a timestamp before this unix timestamp, soft-deleted or not
+    :return: SQLAlchemy criterion
+    """
+    conditions = []
+    if removed_before is not None:
+        conditions.append(sqlalchemy.and_(
+            model_cls.time_removed != jhhalchemy.model.NOT_REMOVED,
+            model_cls.time_removed < removed_before))
+    if older_than is not None:
+        if not hasattr(model_cls, 'time_order'):
+            raise ValueError('older_than needs a TimeOrder model')
+        conditions.append(model_cls.time_order > -older_than)
+    if not conditions:
+        raise ValueError('Set removed_before, older_than or both')
+    return sqlalchemy.or_(*conditions)
+
+
+def archive(session, model_cls, removed_before=None, older_than=None, batch_size=jhhalchemy.model.CHUNK_SIZE,
+            sleep_seconds=0, checkpoint=None, dry_run=False):
+    """
+    Move rows into the model's archive table in primary key batches. Each batch locks its rows with SELECT ... FOR
+    UPDATE, copies them with INSERT ... SELECT and deletes them in one transaction, so a row is never in both tables
+    or in neither.
+
+    :param session: flask_sqlalchemy session object
+    :param model_cls: the class of the model, must set __archive__
+    :param removed_before: archive rows soft-deleted before this unix timestamp
+    :param older_than: archive TimeOrder rows with a timestamp before this unix timestamp, soft-deleted or not
+    :param batch_size: maximum number of rows per batch
+    :param sleep_seconds: pause between batches to leave room for other queries and replication
+    :param checkpoint: a FileCheckpoint (or object with load, save and clear methods) to resume from
+    :param dry_run: count the rows that would be archived without changing anything
+    :return: ArchiveResult
+    """
+    table = model_cls.__table__
+    archive_table = model_cls.__archive_table__
+    if archive_table is None:
+        raise ValueError('{} has no archive table, set __archive__ = True'.format(model_cls.__name__))
+
+    criteria = [archive_criterion(model_cls, removed_before, older_than)]
+    primary_keys = [table.c[column.key] for column in model_cls.__mapper__.primary_key]
+    last = checkpoint.load() if checkpoint is not None and not dry_run else None
+    if last is not None:
+        logger.info('Resuming {} archive after {}'.format(table.name, last))
+        criteria.append(jhhalchemy.model._after_key(primary_keys, last))
+
+    rows = 0
+    batches = 0
+    start = time.time()
+    for batch in model_cls._primary_key_batches(session, criteria, batch_size):
+        in_batch = jhhalchemy.model._in_batch(primary_keys, batch) + criteria
+        if dry_run:
+            rows += session.query(*primary_keys).filter(*in_batch).count()
+        else:
+            keys = session.query(*primary_keys).filter(*in_batch).with_for_update().all()
+            if len(primary_keys) == 1:
+                selected = primary_keys[0].in_([key[0] for key in keys])
+            else:
+                selected = sqlalchemy.tuple_(*primary_keys).in_(keys)
+            session.execute(archive_table.insert().from_select(
+                [column.key for column in table.columns],
+                sqlalchemy.select([table]).where(selected)))
+            session.execute(table.delete().where(selected))
+            session.commit()
+            if model_cls.__cache__ is not None:
+                model_cls.__cache__.invalidate(model_cls, [jhhalchemy.model._identity(key) for key in batch])
+            if checkpoint is not None:
+                checkpoint.save(batch[-1])
+            rows += len(keys)
+        batches += 1
+        logger.info('{} {} rows of {} in {} batches'.format(
+            'Found' if dry_run else 'Archived', rows, table.name, batches))
+        if sleep_seconds:
+            time.sleep(sleep_seconds)
+
+    #
+    # A finished run starts over next time, since rows with lower keys may have been soft-deleted since
+    #
+    if checkpoint is not None and not dry_run:
+        checkpoint.clear()
+    return ArchiveResult(rows, batches, time.time() - start)
@@ -0,0 +1,305 @@
+"""
+Read-through cache for Base model primary key and read_by lookups.
+
+Enable it per model class by setting __cache__:
+
+class MyModel(db.Model):
+    __cache__ = jhhalchemy.model.cache.ModelCache(ttl=60)
+"""
+import collections
+import hashlib
+import jhhalchemy.model
+import sqlalchemy
+import sqlalchemy.event
+import sqlalchemy.orm
+import threading
+import time
+import uuid
+
+#
+# Defaults: seconds an entry lives and maximum number of entries in a LocalBackend
+#
+TTL = 300
+MAX_SIZE = 10000
+
+#
+# Prefix for every cache key, so a shared memcached/redis can tell our entries apart
+#
+KEY_PREFIX = 'jhhalchemy'
+
+#
+# session.info key for the invalidations to repeat once the session's transaction commits
+#
+PENDING = 'jhhalchemy_cache_pending'
+
+#
+# session.info key set when the session's transaction has flushed changes it hasn't committed yet
+#
+WRITTEN = 'jhhalchemy_cache_written'
+
+
+def _uncommitted(session):
+    """
+    Check whether a session may see rows that are not committed, i.e. it has unflushed changes or its transaction has
+    flushed some. Rows loaded through such a session are not cached, since the changes may still be rolled back.
+
+    :param session: session the loader reads with, or None if unknown
+    :return: whether the session has uncommitted changes
+    """
+    if session is None:
+        return False
+    return bool(session.info.get(WRITTEN) or session.new or session.dirty or session.deleted)
+
+
+class LocalBackend(object):
+    """
+    In-process LRU cache with a TTL per entry.
+
+    This is also the backend interface: get(key) returns None on a miss, set(key, value, ttl) and delete(key). To use
+    memcached or redis, wrap the client in an object with those three methods. Values are dicts and lists of column
+    values, so any pickling client can store them.
+    """
+    def __init__(self, max_size=MAX_SIZE):
+        """
+        :param max_size: number of entries to keep before evicting the least recently used one
+        """
+        self.max_size = max_size
+        self.evictions = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Get an entry and mark it as most recently used.
+
+        :param key: cache key
+        :return: value or None if missing or expired
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[1] < time.time():
+                return None
+            self._entries[key] = entry
+            return entry[0]
+
+    def set(self, key, value, ttl):
+        """
+        Add or replace an entry, evicting the least recently used entries if the cache is full.
+
+        :param key: cache key
+        :param value: value to cache
+        :param ttl: seconds until the entry expires
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, time.time() + ttl)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        """
+        Remove an entry if it exists.
+
+        :param key: cache key
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class ModelCache(object):
+    """
+    Caches rows for the model classes whose __cache__ is set to it. One ModelCache can be shared by many classes.
+
+    Entries hold column values, not ORM instances. A hit is rebuilt as a detached instance, so instances are never
+    shared between sessions. To change a hit, add it to a session (session.add) before saving it.
+
+    Primary key entries are deleted when a row is saved or deleted through Base. read_by entries can't be matched to
+    the rows they hold, so their keys include a per-table generation that every save or delete replaces. Changes that
+    are not committed right away are invalidated again once their session commits, since a read in between can cache
+    the old row. Rows read through a session with uncommitted changes are returned but not cached.
+    """
+    def __init__(self, backend=None, ttl=TTL):
+        """
+        :param backend: object with get/set/delete (see LocalBackend), defaults to a new LocalBackend
+        :param ttl: seconds an entry lives
+        """
+        self.backend = backend if backend is not None else LocalBackend()
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @property
+    def evictions(self):
+        """
+        :return: number of entries the backend evicted, if it counts them
+        """
+        return getattr(self.backend, 'evictions', 0)
+
+    def stats(self):
+        """
+        :return: dict of hit, miss and eviction counters
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+    def _count(self, hit):
+        """
+        Increment the hit or miss counter.
+
+        :param hit: whether the lookup was a hit
+        """
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def _pk_key(self, model_cls, pk):
+        """
+        :param model_cls: model class
+        :param pk: primary key value(s)
+        :return: cache key for one row
+        """
+        return '{}:{}:pk:{}'.format(
+            KEY_PREFIX, model_cls.__table__.name, ':'.join(str(value) for value in jhhalchemy.model._identity(pk)))
+
+    def _generation_key(self, model_cls):
+        """
+        :param model_cls: model class
+        :return: cache key for the table's current generation
+        """
+        return '{}:{}:generation'.format(KEY_PREFIX, model_cls.__table__.name)
+
+    def _query_key(self, model_cls, kwargs):
+        """
+        Build the key for a read_by lookup. Hashing keeps arbitrary filter values out of the key, since memcached
+        keys are limited in length and characters.
+
+        :param model_cls: model class
+        :param kwargs: read_by keyword arguments
+        :return: cache key for the lookup in the current generation
+        """
+        generation_key = self._generation_key(model_cls)
+        generation = self.backend.get(generation_key)
+        if generation is None:
+            generation = uuid.uuid4().hex
+            self.backend.set(generation_key, generation, self.ttl)
+        digest = hashlib.sha1(repr(sorted(kwargs.items())).encode('utf-8')).hexdigest()
+        return '{}:{}:by:{}:{}'.format(KEY_PREFIX, model_cls.__table__.name, generation, digest)
+
+    @staticmethod
+    def dump(model):
+        """
+        :param model: model instance
+        :return: dict of column attribute values
+        """
+        return dict((prop.key, getattr(model, prop.key)) for prop in sqlalchemy.inspect(model).mapper.column_attrs)
+
+    @staticmethod
+    def load(model_cls, values):
+        """
+        Rebuild a detached instance from dump's values without calling the model's constructor.
+
+        :param model_cls: model class
+        :param values: dict of column attribute values
+        :return: detached model instance
+        """
+        model = sqlalchemy.inspect(model_cls).class_manager.new_instance()
+        for key, value in values.items():
+            setattr(model, key, value)
+        sqlalchemy.orm.make_transient_to_detached(model)
+        return model
+
+    def get(self, model_cls, pk, loader, session=None):
+        """
+        Look up a row by primary key, calling loader on a miss. Rows that are not found are not cached.
+
+        :param model_cls: model class
+        :param pk: primary key value(s)
+        :param loader: function that returns the model instance or None
+        :param session: session the loader reads with, nothing is cached while it has uncommitted changes
+        :return: model instance or None
+        """
+        key = self._pk_key(model_cls, pk)
+        values = self.backend.get(key)
+        self._count(values is not None)
+        if values is not None:
+            return self.load(model_cls, values)
+        model = loader()
+        if model is not None and not _uncommitted(session):
+            self.backend.set(key, self.dump(model), self.ttl)
+        return model
+
+    def query(self, model_cls, kwargs, loader, session=None):
+        """
+        Look up the result of a read_by, calling loader on a miss.
+
+        :param model_cls: model class
+        :param kwargs: read_by keyword arguments, including removed
+        :param loader: function that returns the list of model instances
+        :param session: session the loader reads with, nothing is cached while it has uncommitted changes
+        :return: list of model instances
+        """
+        key = self._query_key(model_cls, kwargs)
+        values = self.backend.get(key)
+        self._count(values is not None)
+        if values is not None:
+            return [self.load(model_cls, row) for row in values]
+        models = loader()
+        if not _uncommitted(session):
+            self.backend.set(key, [self.dump(model) for model in models], self.ttl)
+        return models
+
+    def invalidate(self, model_cls, pks=(), session=None):
+        """
+        Drop cached rows and start a new generation of read_by entries for the table.
+
+        :param model_cls: model class
+        :param pks: primary key values of the changed rows
+        :param session: session with the uncommitted changes, to invalidate again once it commits
+        """
+        pks = list(pks)
+        for pk in pks:
+            self.backend.delete(self._pk_key(model_cls, pk))
+        self.backend.set(self._generation_key(model_cls), uuid.uuid4().hex, self.ttl)
+        if session is not None:
+            session.info.setdefault(PENDING, []).append(lambda: self.invalidate(model_cls, pks))
+
+    def invalidate_model(self, model, session=None):
+        """
+        Drop everything cached about a saved or deleted instance.
+
+        :param model: model instance
+        :param session: session with the uncommitted change, to invalidate again once it commits (when a new
+            instance has its primary key)
+        """
+        identity = sqlalchemy.inspect(model).identity
+        self.invalidate(type(model), [identity] if identity is not None else [])
+        if session is not None:
+            session.info.setdefault(PENDING, []).append(lambda: self.invalidate_model(model))
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, 'after_flush')
+def _written_after_flush(session, flush_context):
+    """
+    Remember that the session's transaction has uncommitted changes.
+
+    :param session: session
+    :param flush_context: unused
+    """
+    session.info[WRITTEN] = True
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, 'after_commit')
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, 'after_rollback')
+def _invalidate_after_transaction(session):
+    """
+    Repeat the invalidations of the changes the transaction made, once it committed them or rolled them back. After a
+    rollback this drops anything a reader cached from the rolled back changes in the meantime.
+
+    :param session: session
+    """
+    session.info.pop(WRITTEN, None)
+    for invalidate in session.info.pop(PENDING, ()):
+        invalidate()
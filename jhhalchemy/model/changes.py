@@ -0,0 +1,305 @@
+"""
+Change data capture for Base.save and Base.delete.
+
+Enable it per model class by setting __changes__ to a ChangeStream with a sink:
+
+class MyModel(db.Model):
+    __changes__ = jhhalchemy.model.changes.ChangeStream(jhhalchemy.model.changes.QueueSink())
+
+save() and delete() then record a ChangeEvent (insert, update, soft_delete or delete, with the primary key and the
+changed columns). Events are handed to the sink in one batch per commit, after the commit succeeds, and dropped on
+rollback. An OutboxSink instead writes them to an outbox table in the same transaction as the change, so a consumer
+never misses a committed change or sees one that was rolled back.
+
+Only changes made through save() and delete() are captured, not the bulk helpers (save_many, delete_where).
+"""
+import collections
+import jhhalchemy.model
+import json
+import logging
+import sqlalchemy
+import sqlalchemy.event
+import sqlalchemy.orm
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+logger = logging.getLogger(__name__)
+
+#
+# ChangeEvent operations
+#
+INSERT = 'insert'
+UPDATE = 'update'
+SOFT_DELETE = 'soft_delete'
+DELETE = 'delete'
+
+#
+# session.info keys for events waiting for their flush, and flushed events waiting for the commit
+#
+PENDING = 'jhhalchemy_changes_pending'
+FLUSHED = 'jhhalchemy_changes_flushed'
+
+#
+# One captured change. primary_key is the value, or a list of values for composite keys. columns maps the changed
+# column names to their values after the flush (None for values the DB generated, e.g. time_removed on soft delete).
+#
+ChangeEvent = collections.namedtuple('ChangeEvent', ['table', 'operation', 'primary_key', 'columns', 'timestamp'])
+
+
+def _to_json(event):
+    """
+    :param event: ChangeEvent
+    :return: JSON string, values that JSON doesn't support (e.g. datetimes) are converted to strings
+    """
+    return json.dumps(event._asdict(), sort_keys=True, default=str)
+
+
+class QueueSink(object):
+    """
+    Put events on an in-process queue, e.g. for a consumer thread.
+
+    This is also the sink interface: emit(events, session) is called with a list of ChangeEvents. Sinks whose
+    transactional attribute is False get each commit's events after the commit, with session None. Transactional
+    sinks get them right after each flush, inside the transaction, with the session to write with.
+    """
+    transactional = False
+
+    def __init__(self, events_queue=None):
+        """
+        :param events_queue: queue.Queue to put events on, default a new unbounded queue
+        """
+        self.queue = events_queue if events_queue is not None else queue.Queue()
+
+    def emit(self, events, session=None):
+        for event in events:
+            self.queue.put(event)
+
+
+class CallbackSink(object):
+    """
+    Call a function with each commit's events, e.g. to invalidate a cache or publish to a message broker.
+    """
+    transactional = False
+
+    def __init__(self, callback):
+        """
+        :param callback: function of a list of ChangeEvents
+        """
+        self.callback = callback
+
+    def emit(self, events, session=None):
+        self.callback(events)
+
+
+class FileSink(object):
+    """
+    Append events to a local file as JSON lines, one write per commit.
+    """
+    transactional = False
+
+    def __init__(self, path):
+        """
+        :param path: file path
+        """
+        self.path = path
+        self._lock = threading.Lock()
+
+    def emit(self, events, session=None):
+        lines = ''.join(_to_json(event) + '\n' for event in events)
+        with self._lock:
+            with open(self.path, 'a') as events_file:
+                events_file.write(lines)
+
+
+def outbox_table(metadata, name='jhhalchemy_outbox'):
+    """
+    Declare the outbox table for OutboxSink. Create it with metadata.create_all or a migration.
+
+    :param metadata: sqlalchemy.MetaData (usually Flask-SQLAlchemy's db.metadata)
+    :param name: table name
+    :return: sqlalchemy.Table
+    """
+    return sqlalchemy.Table(
+        name, metadata,
+        sqlalchemy.Column('id', sqlalchemy.BigInteger().with_variant(sqlalchemy.Integer, 'sqlite'), primary_key=True),
+        sqlalchemy.Column('event', sqlalchemy.Text, nullable=False),
+        mysql_engine='InnoDB')
+
+
+class OutboxSink(object):
+    """
+    Write events to an outbox table in the same transaction as the change (the transactional outbox pattern). A relay
+    then passes them on with drain().
+    """
+    transactional = True
+
+    def __init__(self, table):
+        """
+        :param table: table from outbox_table
+        """
+        self.table = table
+
+    def emit(self, events, session=None):
+        session.execute(self.table.insert(), [{'event': _to_json(event)} for event in events])
+
+    def drain(self, session, callback, batch_size=jhhalchemy.model.CHUNK_SIZE):
+        """
+        Pass the outbox's events to a function in order, deleting each batch once the function returns. Events are
+        delivered at least once: if the function or the commit fails, the batch is delivered again next time.
+
+        :param session: session to read and delete with
+        :param callback: function of a list of ChangeEvents
+        :param batch_size: maximum number of events per call
+        :return: number of events delivered
+        """
+        count = 0
+        while True:
+            rows = session.execute(
+                sqlalchemy.select([self.table]).order_by(self.table.c.id).limit(batch_size)).fetchall()
+            if not rows:
+                return count
+            callback([ChangeEvent(**json.loads(row.event)) for row in rows])
+            session.execute(self.table.delete().where(self.table.c.id <= rows[-1].id))
+            session.commit()
+            count += len(rows)
+
+
+class ChangeStream(object):
+    """
+    Records a model class's saves and deletes for its sink.
+    """
+    def __init__(self, sink):
+        """
+        :param sink: QueueSink, CallbackSink, FileSink, OutboxSink or another object with the sink interface
+        """
+        self.sink = sink
+
+    def track_save(self, session, model):
+        """
+        Record an insert or update. Called by Base.save. Saving an instance without changes records nothing.
+
+        :param session: session the change is made in
+        :param model: model instance
+        """
+        self.track(session, model, UPDATE if sqlalchemy.inspect(model).has_identity else INSERT)
+
+    def track_delete(self, session, model, soft):
+        """
+        Record a soft or hard delete. Called by Base.delete.
+
+        :param session: session the change is made in
+        :param model: model instance
+        :param soft: whether this is a soft delete
+        """
+        self.track(session, model, SOFT_DELETE if soft else DELETE)
+
+    def track(self, session, model, operation):
+        """
+        Remember a change until its flush.
+
+        :param session: session the change is made in
+        :param model: model instance
+        :param operation: INSERT, UPDATE, SOFT_DELETE or DELETE
+        """
+        state = sqlalchemy.inspect(model)
+        keys = [attribute.key for attribute in state.mapper.column_attrs]
+        if operation == INSERT:
+            columns = [key for key in keys if key in state.dict]
+        elif operation == UPDATE:
+            columns = [key for key in keys if state.attrs[key].history.has_changes()]
+            if not columns:
+                return
+        elif operation == SOFT_DELETE:
+            columns = ['time_removed']
+        else:
+            columns = []
+        session.info.setdefault(PENDING, []).append((self, model, operation, columns))
+
+
+def _event(model, operation, columns):
+    """
+    :param model: flushed model instance
+    :param operation: change operation
+    :param columns: changed column names
+    :return: ChangeEvent
+    """
+    state = sqlalchemy.inspect(model)
+    identity = list(state.identity)
+    return ChangeEvent(
+        state.mapper.local_table.name,
+        operation,
+        identity[0] if len(identity) == 1 else identity,
+        dict((key, state.dict.get(key)) for key in columns),
+        time.time())
+
+
+def _emit(session, flushed):
+    """
+    Hand events to their sinks, one batch per stream.
+
+    :param session: session for transactional sinks, None after the commit
+    :param flushed: list of (stream, event)
+    """
+    batches = collections.OrderedDict()
+    for stream, event in flushed:
+        batches.setdefault(stream, []).append(event)
+    for stream, events in batches.items():
+        stream.sink.emit(events, session)
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, 'after_flush_postexec')
+def _after_flush(session, flush_context):
+    """
+    Turn the changes this flush wrote into events, once the flushed models have their identities. Transactional sinks
+    write them now, the others wait for the commit.
+
+    :param session: session
+    :param flush_context: unused
+    """
+    pending = session.info.get(PENDING)
+    if not pending:
+        return
+    flushed = []
+    waiting = []
+    for stream, model, operation, columns in pending:
+        if sqlalchemy.inspect(model).identity is None:
+            waiting.append((stream, model, operation, columns))
+        else:
+            flushed.append((stream, _event(model, operation, columns)))
+    session.info[PENDING] = waiting
+    _emit(session, [(stream, event) for stream, event in flushed if stream.sink.transactional])
+    session.info.setdefault(FLUSHED, []).extend(
+        (stream, event) for stream, event in flushed if not stream.sink.transactional)
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, 'after_commit')
+def _after_commit(session):
+    """
+    Hand the committed events to their sinks. The commit can't be undone anymore, so sink errors are logged. Changes
+    that were never flushed (e.g. of models removed from the session) are dropped, not carried into later commits.
+
+    :param session: session
+    """
+    session.info.pop(PENDING, None)
+    flushed = session.info.pop(FLUSHED, None)
+    if flushed:
+        try:
+            _emit(None, flushed)
+        except Exception:
+            logger.exception('Could not emit {} change events'.format(len(flushed)))
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, 'after_rollback')
+def _after_rollback(session):
+    """
+    Drop the events of the rolled back changes.
+
+    :param session: session
+    """
+    session.info.pop(PENDING, None)
+    session.info.pop(FLUSHED, None)
@@ -1,9 +1,21 @@
 """
 flask_sqlachemy model mixin for TimeOrder tables
 """
+import array
+import base64
+import collections
+import jhhalchemy.instrument
+import jhhalchemy.model
+import json
 import sqlalchemy
+import time
 from sqlalchemy import desc
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 class TimeOrderMixin(object):
     """
@@ -13,6 +25,17 @@ class TimeOrderMixin(object):
     """
     time_order = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
 
+    #
+    # Set to a tuple of column names to declare an index on (<columns>, time_removed, time_order) for range reads
+    #
+    __time_order_index__ = None
+
+    #
+    # Set to True to RANGE partition the table on time_order in MySQL (see jhhalchemy.migrate.roll_partitions). MySQL
+    # requires every unique key to include time_order, so declare time_order as part of the primary key.
+    #
+    __time_order_partitioned__ = False
+
     @property
     def timestamp(self):
         """
@@ -42,17 +65,189 @@ class TimeOrderMixin(object):
         AND time_order >= -<end_timestamp>
 
         :param args: SQLAlchemy filter criteria, (e.g., uid == uid, type == 1)
-        :param kwargs: start_timestamp and end_timestamp are the only kwargs, they specify the range (inclusive)
-        :return: model generator
+        :param kwargs: start_timestamp and end_timestamp specify the range (inclusive), columns and raw the projection
+        :keyword columns: column names or attributes to select, the query then returns named tuples instead of models
+        :keyword raw: if set, return named tuples of every column instead of models
+        :return: model (or named tuple) generator
+        """
+        criteria = list(args) + cls.time_range_criteria(kwargs.get('start_timestamp'), kwargs.get('end_timestamp'))
+        models = cls.read(*criteria)
+        if kwargs.get('raw') or kwargs.get('columns'):
+            #
+            # Plain rows skip ORM identity map and attribute instrumentation, which dominates CPU for wide reads
+            #
+            models = models.with_entities(*_column_attributes(cls, kwargs.get('columns')))
+        return jhhalchemy.instrument.tag(models, helper='read_time_range')
+
+    @classmethod
+    def time_range_criteria(cls, start_timestamp=None, end_timestamp=None):
+        """
+        Build the time_order conditions for an inclusive time range.
+
+        :param start_timestamp: earliest timestamp, or None for no lower bound
+        :param end_timestamp: latest timestamp, or None for no upper bound
+        :return: list of SQLAlchemy criteria
+        """
+        criteria = []
+        if start_timestamp is not None:
+            criteria.append(cls.time_order <= -start_timestamp)
+        if end_timestamp is not None:
+            criteria.append(cls.time_order >= -end_timestamp)
+        return criteria
+
+    @classmethod
+    def read_as_of(cls, timestamp, *args):
+        """
+        Get the most recent model set at or before a timestamp, i.e. the one in effect at that time. Uses
+        time_dsc_index
+
+        SELECT *
+        FROM <table>
+        WHERE time_order >= -<timestamp>
+        ORDER BY time_order
+        LIMIT 1
+
+        :param timestamp: unix timestamp
+        :param args: SQLAlchemy filter criteria, (e.g., uid == uid, type == 1)
+        :return: model or None
+        """
+        query = jhhalchemy.instrument.tag(cls.read(cls.time_order >= -timestamp, *args), helper='read_as_of')
+        return query.order_by(cls.time_order).first()
+
+    @classmethod
+    def read_as_of_many(cls, key_column, keys, timestamp, *args, **kwargs):
+        """
+        read_as_of for many keys (e.g., uids) with one query per batch of keys:
+
+        SELECT <table>.*
+        FROM <table>
+        JOIN (
+            SELECT <key_column> AS latest_key, MIN(time_order) AS time_order
+            FROM <table>
+            WHERE <key_column> IN (<keys>)
+            AND time_order >= -<timestamp>
+            GROUP BY <key_column>) AS latest
+        ON <key_column> = latest.latest_key AND time_order = latest.time_order
+
+        With an index on (<key_column>, time_order), MySQL resolves the subquery with one index dive per key.
+
+        :param key_column: model attribute the keys are values of, e.g. cls.uid
+        :param keys: key values
+        :param timestamp: unix timestamp
+        :param args: additional SQLAlchemy filter criteria
+        :param kwargs: batch_size is the only kwarg, the maximum number of keys per query, defaults to CHUNK_SIZE
+        :return: dict of key -> model, or None if the key had no model at that time
+        """
+        models = dict((key, None) for key in keys)
+        for batch in jhhalchemy.model._chunks(list(models), kwargs.get('batch_size', jhhalchemy.model.CHUNK_SIZE)):
+            latest = cls.read(key_column.in_(batch), cls.time_order >= -timestamp, *args).with_entities(
+                key_column.label('latest_key'),
+                sqlalchemy.func.min(cls.time_order).label('time_order')).group_by(key_column).subquery()
+            query = jhhalchemy.instrument.tag(cls.read(*args), helper='read_as_of_many').join(
+                latest,
+                sqlalchemy.and_(key_column == latest.c.latest_key, cls.time_order == latest.c.time_order))
+            for model in query:
+                key = getattr(model, key_column.key)
+                if models[key] is None:
+                    models[key] = model
+        return models
+
+    @classmethod
+    def aggregate_range(cls, bucket_seconds, aggregates, *args, **kwargs):
+        """
+        Aggregate a time range per time bucket in one query, e.g. hourly counts or daily averages:
+
+        SELECT FLOOR((-time_order + <offset>) / <bucket_seconds>) * <bucket_seconds> - <offset> AS bucket, <aggregates>
+        FROM <table>
+        WHERE time_order <= -<start_timestamp>
+        AND time_order >= -<end_timestamp>
+        GROUP BY bucket
+        ORDER BY bucket
+
+        The range is inclusive like read_time_range, so unlike get_by_range the model set before start_timestamp is not
+        included. Buckets without models are left out.
+
+        :param bucket_seconds: bucket width, e.g. 3600 for hourly buckets
+        :param aggregates: dict (or list of pairs) of result name -> SQL aggregate, e.g. {'steps': func.sum(cls.steps)}
+        :param args: SQLAlchemy filter criteria, (e.g., uid == uid, type == 1)
+        :param kwargs: start_timestamp and end_timestamp specify the range (inclusive), as well as offset_seconds
+        :keyword offset_seconds: UTC offset to align buckets to, e.g. -28800 for days starting at midnight in UTC-8
+        :return: query of named tuples (bucket, <aggregates>), bucket is the unix timestamp the bucket starts at
         """
-        criteria = list(args)
-        start = kwargs.get('start_timestamp')
-        end = kwargs.get('end_timestamp')
-        if start is not None:
-            criteria.append(cls.time_order <= -start)
-        if end is not None:
-            criteria.append(cls.time_order >= -end)
-        return cls.read(*criteria)
+        bucket_seconds = int(bucket_seconds)
+        if bucket_seconds <= 0:
+            raise ValueError('bucket_seconds must be positive')
+        start_timestamp = kwargs.get('start_timestamp')
+        end_timestamp = kwargs.get('end_timestamp')
+        _check_range(start_timestamp, end_timestamp)
+
+        #
+        # Inline the bucket constants so the GROUP BY expression is identical to the selected one (MySQL's
+        # ONLY_FULL_GROUP_BY compares the statement text, and bound parameters would each get their own placeholder)
+        #
+        width = sqlalchemy.literal_column(str(bucket_seconds))
+        offset_seconds = int(kwargs.get('offset_seconds', 0))
+        if offset_seconds:
+            offset = sqlalchemy.literal_column(str(offset_seconds))
+            bucket = sqlalchemy.func.floor((-cls.time_order + offset) / width) * width - offset
+        else:
+            bucket = sqlalchemy.func.floor(-cls.time_order / width) * width
+
+        items = aggregates.items() if hasattr(aggregates, 'items') else aggregates
+        query = cls.read_time_range(*args, start_timestamp=start_timestamp, end_timestamp=end_timestamp).with_entities(
+            bucket.label('bucket'),
+            *[aggregate.label(name) for name, aggregate in items])
+        return jhhalchemy.instrument.tag(query.group_by(bucket).order_by(bucket), helper='aggregate_range')
+
+
+@sqlalchemy.event.listens_for(TimeOrderMixin, 'instrument_class', propagate=True)
+def _declare_time_order_index(mapper, cls):
+    """
+    Declare the __time_order_index__ index when a model class is mapped.
+
+    :param mapper: the model's mapper
+    :param cls: model class
+    """
+    if cls.__time_order_index__ and mapper.local_table is not None:
+        jhhalchemy.model._declare_index(
+            mapper.local_table,
+            'time_order',
+            tuple(cls.__time_order_index__) + ('time_removed', 'time_order'))
+
+
+#
+# Partitioned tables start with one partition for every row, the migrate partition helpers split newer ones off it
+#
+OLD_PARTITION = 'p_old'
+PARTITION_BY = 'RANGE (time_order) (PARTITION {} VALUES LESS THAN MAXVALUE)'.format(OLD_PARTITION)
+
+
+@sqlalchemy.event.listens_for(TimeOrderMixin, 'instrument_class', propagate=True)
+def _declare_time_order_partitions(mapper, cls):
+    """
+    Declare MySQL RANGE partitioning on time_order when a model class with __time_order_partitioned__ is mapped.
+
+    :param mapper: the model's mapper
+    :param cls: model class
+    """
+    table = mapper.local_table
+    if cls.__time_order_partitioned__ and table is not None:
+        table.dialect_kwargs['mysql_partition_by'] = PARTITION_BY
+        sqlalchemy.event.listen(table, 'before_create', _check_partition_key)
+
+
+def _check_partition_key(table, connection, **kwargs):
+    """
+    Fail before CREATE TABLE with a clear message if a partitioned table's primary key is missing time_order. Checked
+    at create time rather than when mapping, since an exception while mapping breaks every other mapper too.
+
+    :param table: sqlalchemy.Table
+    :param connection: connection the table is created on
+    :param kwargs: other before_create event arguments
+    """
+    if connection.dialect.name == 'mysql' and 'time_order' not in table.primary_key.columns:
+        raise sqlalchemy.exc.ArgumentError(
+            '{} is partitioned on time_order, so time_order must be part of its primary key'.format(table.name))
 
 
 """
@@ -67,6 +262,63 @@ class InvalidTimestampRange(Exception):
     pass
 
 
+class InvalidCursor(Exception):
+    """
+    Raise this when a page cursor is malformed or was created for the other sort direction
+    """
+    pass
+
+
+#
+# Default number of models per page for get_page
+#
+PAGE_SIZE = 100
+
+#
+# Default number of models per batch for iter_by_range
+#
+BATCH_SIZE = 1000
+
+#
+# One page of models and the cursor for the next one (None on the last page)
+#
+Page = collections.namedtuple('Page', ['models', 'cursor'])
+
+#
+# array typecodes for get_columns: 64-bit integers where supported (Python 3), doubles for floats and nullable columns
+#
+INTEGER_TYPECODE = 'q' if 'q' in getattr(array, 'typecodes', '') else 'l'
+FLOAT_TYPECODE = 'd'
+
+#
+# Default rows per batch for get_columns. Typed arrays are compact, so larger batches than iter_by_range's are cheap.
+#
+COLUMN_BATCH_SIZE = 10000
+
+
+class StreamStats(object):
+    """
+    Throughput counters for iter_by_range. seconds only counts time spent fetching batches, not time spent by the
+    caller processing them.
+    """
+    def __init__(self):
+        self.rows = 0
+        self.batches = 0
+        self.peak_batch = 0
+        self.seconds = 0.0
+
+    @property
+    def rows_per_second(self):
+        """
+        Fetch throughput
+
+        :return: rows per second, 0 before the first batch
+        """
+        if not self.seconds:
+            return 0.0
+        return self.rows / self.seconds
+
+
 def get_by_range(model_cls, *args, **kwargs):
     """
     Get ordered list of models for the specified time range.
@@ -79,23 +331,287 @@ def get_by_range(model_cls, *args, **kwargs):
     :keyword start_timestamp: the most recent models set before this and all after, defaults to 0
     :keyword end_timestamp: only models set before (and including) this timestamp, defaults to now
     :keyword asc: boolean, if set orders timestamps in ascending order
-    :return: model generator
+    :keyword columns: column names or attributes to select, the query then returns named tuples instead of models
+    :keyword raw: if set, return named tuples of every column instead of models
+    :return: model (or named tuple) generator
     """
     start_timestamp = kwargs.get('start_timestamp')
     end_timestamp = kwargs.get('end_timestamp')
-    asc = kwargs.get('asc')
+    _check_range(start_timestamp, end_timestamp)
+
+    models = model_cls.read_time_range(*args,
+                                       start_timestamp=start_timestamp,
+                                       end_timestamp=end_timestamp,
+                                       columns=kwargs.get('columns'),
+                                       raw=kwargs.get('raw', False))
+    models = models.order_by(_range_order(model_cls, kwargs.get('asc')))
+
+    return jhhalchemy.instrument.tag(models, helper='get_by_range')
 
+
+def _check_range(start_timestamp, end_timestamp):
+    """
+    Raise InvalidTimestampRange if start_timestamp > end_timestamp.
+
+    :param start_timestamp: start of the range or None
+    :param end_timestamp: end of the range or None
+    """
     if (start_timestamp is not None) and (end_timestamp is not None) and (start_timestamp > end_timestamp):
         raise InvalidTimestampRange
 
+
+def _range_order(model_cls, asc):
+    """
+    Get the ORDER BY clause for a range read.
+
+    :param model_cls: the class of the model
+    :param asc: boolean, if set orders timestamps in ascending order
+    :return: SQLAlchemy order by clause
+    """
     if asc is not None and asc is True:
         # To order ascending, the DB needs to order *descending* due to the negation on the time_order column
-        models = model_cls.read_time_range(*args,
-                                           start_timestamp=start_timestamp,
-                                           end_timestamp=end_timestamp).order_by(desc(model_cls.time_order))
-    else:
-        models = model_cls.read_time_range(*args,
-                                           start_timestamp=start_timestamp,
-                                           end_timestamp=end_timestamp).order_by(model_cls.time_order)
+        return desc(model_cls.time_order)
+    return model_cls.time_order
 
+
+def get_by_range_many(model_cls, key_column, keys, *args, **kwargs):
+    """
+    get_by_range for many keys (e.g., uids) with one IN query per batch of keys instead of one query per key.
+
+    :param model_cls: the class of the model to return
+    :param key_column: model attribute the keys are values of, e.g. model_cls.uid
+    :param keys: key values
+    :param args: additional arguments specific to the model class
+    :param kwargs: start_timestamp, end_timestamp, asc, columns and raw as in get_by_range, plus batch_size. key_column
+        is added to columns if missing since the results are grouped by it.
+    :keyword batch_size: maximum number of keys per query, defaults to CHUNK_SIZE
+    :return: OrderedDict of key -> list of models (or named tuples), in the order get_by_range returns them for that key
+    """
+    batch_size = kwargs.pop('batch_size', jhhalchemy.model.CHUNK_SIZE)
+    if kwargs.get('columns'):
+        columns = _column_attributes(model_cls, kwargs['columns'])
+        if key_column.key not in set(column.key for column in columns):
+            kwargs['columns'] = columns + [key_column]
+    models = collections.OrderedDict((key, []) for key in keys)
+    for batch in jhhalchemy.model._chunks(list(models), batch_size):
+        for model in get_by_range(model_cls, key_column.in_(batch), *args, **kwargs):
+            models[getattr(model, key_column.key)].append(model)
     return models
+
+
+def _seek_keys(model_cls):
+    """
+    Get the columns that uniquely order a time_order model: time_order, then the primary key.
+
+    :param model_cls: the class of the model
+    :return: list of model attributes
+    """
+    mapper = sqlalchemy.inspect(model_cls)
+    return [model_cls.time_order] + [
+        getattr(model_cls, mapper.get_property_by_column(column).key) for column in mapper.primary_key]
+
+
+def _column_attributes(model_cls, columns=None):
+    """
+    Get the model attributes to select plain tuples instead of models.
+
+    :param model_cls: the class of the model
+    :param columns: column names or model attributes, defaults to every mapped column
+    :return: list of model attributes
+    """
+    if not columns:
+        return [getattr(model_cls, prop.key) for prop in sqlalchemy.inspect(model_cls).column_attrs]
+    return [getattr(model_cls, column) if isinstance(column, sqlalchemy.util.string_types) else column
+            for column in columns]
+
+
+def _encode_cursor(values, asc):
+    """
+    Make an opaque, URL-safe cursor from the seek key values of the last model on a page.
+
+    :param values: seek key values
+    :param asc: sort direction the cursor is valid for
+    :return: cursor string
+    """
+    payload = json.dumps([asc] + list(values), separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii')
+
+
+def _decode_cursor(cursor, asc, length):
+    """
+    Get the seek key values back out of a cursor.
+
+    :param cursor: cursor string from _encode_cursor
+    :param asc: current sort direction
+    :param length: number of seek keys
+    :return: seek key values
+    """
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor).decode('utf-8'))
+    except (TypeError, ValueError):
+        raise InvalidCursor
+    if not isinstance(payload, list) or len(payload) != length + 1 or payload[0] is not asc:
+        raise InvalidCursor
+    return payload[1:]
+
+
+def _seek_criterion(keys, values, asc):
+    """
+    Build the condition for rows after the seek key values in sort order, i.e. (keys) > (values), or < for asc since
+    ascending timestamps are descending time_orders. It is expanded into ORs of ANDs rather than a row comparison so
+    that MySQL can use it as an index range.
+
+    :param keys: seek key attributes
+    :param values: seek key values
+    :param asc: sort direction
+    :return: SQLAlchemy criterion
+    """
+    clauses = []
+    for i, key in enumerate(keys):
+        bound = key < values[i] if asc else key > values[i]
+        clauses.append(sqlalchemy.and_(*[keys[j] == values[j] for j in range(i)] + [bound]))
+    return sqlalchemy.or_(*clauses)
+
+
+def get_page(model_cls, *args, **kwargs):
+    """
+    Get one page of get_by_range results with keyset (seek) pagination. Instead of an OFFSET, each page starts right
+    after the (time_order, primary key) of the previous page's last model, so every page costs the same as the first.
+
+    :param model_cls: the class of the model to return
+    :param args: arguments specific to the model class
+    :param kwargs: start_timestamp, end_timestamp and asc as in get_by_range, plus cursor and limit
+    :keyword cursor: cursor from the previous Page, omit for the first page
+    :keyword limit: maximum number of models on the page, defaults to PAGE_SIZE
+    :keyword columns: column names or attributes to select, the page then holds named tuples instead of models. The
+        time_order and primary key columns are added if missing since the cursor needs them.
+    :keyword raw: if set, the page holds named tuples of the column values instead of models
+    :return: Page(models, cursor), cursor is None when there are no more models
+    """
+    asc = kwargs.get('asc') is True
+    limit = kwargs.get('limit', PAGE_SIZE)
+    cursor = kwargs.get('cursor')
+
+    #
+    # Break time_order ties with the primary key, in the same direction so the index can be scanned either way.
+    #
+    keys = _seek_keys(model_cls)
+    models = get_by_range(model_cls,
+                          *args,
+                          start_timestamp=kwargs.get('start_timestamp'),
+                          end_timestamp=kwargs.get('end_timestamp'),
+                          asc=asc).order_by(*[desc(key) if asc else key for key in keys[1:]])
+    models = jhhalchemy.instrument.tag(models, helper='get_page')
+    if cursor is not None:
+        models = models.filter(_seek_criterion(keys, _decode_cursor(cursor, asc, len(keys)), asc))
+    if kwargs.get('raw') or kwargs.get('columns'):
+        entities = _column_attributes(model_cls, kwargs.get('columns'))
+        selected = set(entity.key for entity in entities)
+        models = models.with_entities(*entities + [key for key in keys if key.key not in selected])
+
+    #
+    # Fetch one extra model to find out if there is another page.
+    #
+    models = models.limit(limit + 1).all()
+    if len(models) <= limit:
+        return Page(models, None)
+    models = models[:limit]
+    return Page(models, _encode_cursor([getattr(models[-1], key.key) for key in keys], asc))
+
+
+def iter_by_range(model_cls, *args, **kwargs):
+    """
+    Stream get_by_range results in batches for ranges too big to load at once. Each batch is a keyset page (see
+    get_page), so memory is bounded by batch_size and every batch costs the same no matter how deep into the range it
+    is. Unlike a server-side cursor, no result set is held open while the caller processes a batch, but the pages run
+    on the model's scoped session, whose transaction stays open until the caller commits or rolls back. To keep a
+    long stream from holding one MySQL read view (and its undo history) open throughout, end the session's transaction
+    between batches once the caller is done with them.
+
+    :param model_cls: the class of the model to return
+    :param args: arguments specific to the model class
+    :param kwargs: start_timestamp, end_timestamp, asc, cursor, columns and raw as in get_page, plus batch_size and
+        stats
+    :keyword batch_size: maximum number of models per batch, defaults to BATCH_SIZE
+    :keyword stats: a StreamStats object to update as batches are fetched
+    :return: generator of model (or tuple, if raw) lists
+    """
+    kwargs['limit'] = kwargs.pop('batch_size', BATCH_SIZE)
+    stats = kwargs.pop('stats', None)
+    while True:
+        start = time.time()
+        page = get_page(model_cls, *args, **kwargs)
+        if stats is not None:
+            stats.seconds += time.time() - start
+            stats.rows += len(page.models)
+            stats.batches += 1
+            stats.peak_batch = max(stats.peak_batch, len(page.models))
+        if page.models:
+            yield page.models
+        if page.cursor is None:
+            return
+        kwargs['cursor'] = page.cursor
+
+
+def _typecode(column):
+    """
+    Pick the array typecode for a column's values.
+
+    :param column: sqlalchemy.Column
+    :return: array typecode, or None for non-numeric columns
+    """
+    if isinstance(column.type, sqlalchemy.Integer) and not column.nullable:
+        return INTEGER_TYPECODE
+    if isinstance(column.type, (sqlalchemy.Integer, sqlalchemy.Numeric)):
+        return FLOAT_TYPECODE
+    return None
+
+
+def get_columns(model_cls, columns, *args, **kwargs):
+    """
+    Read a time range straight into one array per column, for analytics code that works on whole columns rather than
+    models. Rows are streamed in keyset batches (see iter_by_range) and appended to typed arrays, so no model or row
+    object outlives its batch.
+
+    Non-null integer columns become 64-bit integer arrays, other numeric columns become double arrays with NaN for NULL
+    and any other column becomes a list. With NumPy installed, the arrays are returned as ndarrays sharing the same
+    memory.
+
+    :param model_cls: the class of the model to read
+    :param columns: column names or model attributes
+    :param args: arguments specific to the model class
+    :param kwargs: start_timestamp, end_timestamp, asc, batch_size and stats as in iter_by_range
+    :keyword batch_size: maximum number of rows per batch, defaults to COLUMN_BATCH_SIZE
+    :keyword use_numpy: set to False to get array.array objects even if NumPy is installed
+    :return: OrderedDict of column name -> values, in range order, plus 'timestamp' (converted from time_order)
+    """
+    use_numpy = kwargs.pop('use_numpy', True) and numpy is not None
+    kwargs.setdefault('batch_size', COLUMN_BATCH_SIZE)
+    attributes = _column_attributes(model_cls, columns)
+    typecodes = [_typecode(attribute.property.columns[0]) for attribute in attributes]
+    result = collections.OrderedDict(
+        (attribute.key, array.array(typecode) if typecode else [])
+        for attribute, typecode in zip(attributes, typecodes))
+    timestamps = array.array(INTEGER_TYPECODE)
+
+    #
+    # Select time_order right after the requested columns so its position is known; get_page appends the primary key.
+    #
+    time_index = len(attributes)
+    kwargs['columns'] = attributes + [model_cls.time_order]
+    for batch in iter_by_range(model_cls, *args, **kwargs):
+        for i, (values, typecode) in enumerate(zip(result.values(), typecodes)):
+            if typecode == FLOAT_TYPECODE:
+                values.extend(float('nan') if row[i] is None else row[i] for row in batch)
+            else:
+                values.extend(row[i] for row in batch)
+        timestamps.extend(-row[time_index] for row in batch)
+
+    result['timestamp'] = timestamps
+    if use_numpy:
+        for name, values in result.items():
+            if isinstance(values, array.array):
+                result[name] = numpy.frombuffer(values, dtype=values.typecode)
+            else:
+                result[name] = numpy.array(values, dtype=object)
+    return result
@@ -1,4 +1,4 @@
-from distutils.core import setup
+from setuptools import setup
 
 setup(
     name='jhhalchemy',
@@ -8,5 +8,11 @@ setup(
     license='Apache',
     author='Ray Courtney',
     author_email='ray@jawbone.com',
-    description='SQLAlchemy base model and CRUD methods for Jawbone Health'
+    description='SQLAlchemy base model and CRUD methods for Jawbone Health',
+    extras_require={
+        #
+        # jhhalchemy.model.aio needs SQLAlchemy's asyncio extension, which is Python 3 only
+        #
+        'aio': ['SQLAlchemy>=1.4,<2.0; python_version >= "3.6"'],
+    }
 )
@@ -5,6 +5,8 @@ Creates a simple model that inherits from base and then exercises and verifies t
 See conftest.py to setup your DB details in the fixtures
 """
 import jhhalchemy.model
+import jhhalchemy.model.archive
+import jhhalchemy.model.changes
 import pytest
 import sqlalchemy
 import time
@@ -85,3 +87,90 @@ def test_base(db, model):
     #
     deleted_tester.delete(db.session, soft=False)
     assert cls.read_by(name=model.name).first() is None
+
+
+def test_get(db, model):
+    """
+    Verify primary key lookups with and without the identity map
+
+    :param db: flask_sqlalchemy object
+    :param model: instantiated model fixture
+    """
+    model.save(db.session)
+    cls = model.__class__
+    assert cls.get(model.name_id) is model
+    assert cls.get_many([model.name_id, -1]) == {model.name_id: model}
+
+    #
+    # Not in the identity map anymore -> query
+    #
+    db.session.expunge_all()
+    assert cls.get(model.name_id).name == model.name
+    assert list(cls.get_many([model.name_id])) == [model.name_id]
+
+    #
+    # Soft-deleted
+    #
+    cls.get(model.name_id).delete(db.session)
+    assert cls.get(model.name_id) is None
+    assert cls.get_many([model.name_id]) == {}
+    db.session.expunge_all()
+    assert cls.get_many([model.name_id]) == {}
+    assert cls.get(model.name_id, removed=True).name == model.name
+
+
+def test_archive(db, tmpdir):
+    """
+    Verify soft-deleted rows move to the archive table and can still be read
+
+    :param db: flask_sqlalchemy object
+    :param tmpdir: pytest temporary directory
+    """
+    class ArchivedModel(db.Model):
+        __archive__ = True
+        archived_id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+        name = sqlalchemy.Column(sqlalchemy.String(255))
+
+    db.create_all()
+    ArchivedModel.save_many(db.session, [{'name': str(i)} for i in range(5)])
+    assert ArchivedModel.delete_where(db.session, ArchivedModel.name.in_(['1', '3'])) == 2
+
+    checkpoint = jhhalchemy.model.archive.FileCheckpoint(str(tmpdir.join('checkpoint.json')))
+    removed_before = time.time() + 1
+    assert jhhalchemy.model.archive.archive(
+        db.session, ArchivedModel, removed_before=removed_before, dry_run=True).rows == 2
+    result = jhhalchemy.model.archive.archive(
+        db.session, ArchivedModel, removed_before=removed_before, batch_size=1, checkpoint=checkpoint)
+    assert (result.rows, result.batches) == (2, 2)
+    assert checkpoint.load() is None
+
+    assert sorted(model.name for model in ArchivedModel.read(removed=True)) == ['0', '2', '4']
+    assert sorted(model.name for model in ArchivedModel.read(removed=True, archived=True)) == ['0', '1', '2', '3', '4']
+    assert sorted(model.name for model in ArchivedModel.read(archived=True)) == ['0', '2', '4']
+
+
+def test_changes(db):
+    """
+    Verify committed saves and deletes are written to the outbox with their primary keys
+
+    :param db: flask_sqlalchemy object
+    """
+    outbox = jhhalchemy.model.changes.OutboxSink(jhhalchemy.model.changes.outbox_table(db.metadata))
+
+    class ChangedModel(db.Model):
+        __changes__ = jhhalchemy.model.changes.ChangeStream(outbox)
+        changed_id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+        name = sqlalchemy.Column(sqlalchemy.String(255))
+
+    db.create_all()
+    model = ChangedModel(name='a')
+    model.save(db.session)
+    model.name = 'b'
+    model.save(db.session)
+    model.delete(db.session)
+
+    events = []
+    assert outbox.drain(db.session, events.extend) == 3
+    assert [(event.operation, event.primary_key) for event in events] == [
+        ('insert', model.changed_id), ('update', model.changed_id), ('soft_delete', model.changed_id)]
+    assert events[1].columns == {'name': 'b'}
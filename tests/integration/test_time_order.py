@@ -4,6 +4,8 @@ Creates a simple model that uses the TimeOrderBase mixin and verifies the method
 
 See conftest.py to setup your DB details in the fixtures
 """
+import collections
+import jhhalchemy.migrate
 import jhhalchemy.model.time_order
 import pytest
 import sqlalchemy
@@ -132,3 +134,149 @@ def test_get_by_range(model):
     end_ts = 0
     toms = jhhalchemy.model.time_order.get_by_range(model_cls, end_timestamp=end_ts)
     assert [tom.timestamp for tom in toms] == []
+
+
+def test_get_by_range_columns(model):
+    """
+    Verify projected and raw range reads return named tuples
+
+    :param model: test model fixture
+    """
+    model_cls = model.__class__
+    expected = [(tom.name_id, tom.timestamp) for tom in jhhalchemy.model.time_order.get_by_range(model_cls)]
+    rows = jhhalchemy.model.time_order.get_by_range(model_cls, columns=['name_id', 'time_order']).all()
+    assert [(row.name_id, -row.time_order) for row in rows] == expected
+    assert not isinstance(rows[0], model_cls)
+
+    rows = jhhalchemy.model.time_order.get_by_range(model_cls, end_timestamp=10, raw=True).all()
+    assert [row.name for row in rows] == ['1', '3']
+
+
+def test_get_columns(model):
+    """
+    Verify columnar reads match get_by_range
+
+    :param model: test model fixture
+    """
+    model_cls = model.__class__
+    toms = jhhalchemy.model.time_order.get_by_range(model_cls).all()
+    columns = jhhalchemy.model.time_order.get_columns(model_cls, ['name_id', 'name'], batch_size=2, use_numpy=False)
+    assert list(columns['name_id']) == [tom.name_id for tom in toms]
+    assert columns['name'] == [tom.name for tom in toms]
+    assert list(columns['timestamp']) == [tom.timestamp for tom in toms]
+
+
+def test_aggregate_range(model):
+    """
+    Verify bucketed aggregates match the models in the range
+
+    :param model: test model fixture
+    """
+    model_cls = model.__class__
+    timestamps = [tom.timestamp for tom in model_cls.read_time_range(end_timestamp=25)]
+    expected = collections.Counter(timestamp // 20 * 20 for timestamp in timestamps)
+    rows = model_cls.aggregate_range(20, {'count': sqlalchemy.func.count()}, end_timestamp=25).all()
+    assert [(row.bucket, row.count) for row in rows] == sorted(expected.items())
+
+
+def test_get_page(model):
+    """
+    Verify keyset pagination walks the same models in the same order as get_by_range
+
+    :param model: test model fixture
+    """
+    model_cls = model.__class__
+    for asc in (False, True):
+        expected = [tom.name_id for tom in jhhalchemy.model.time_order.get_by_range(model_cls, asc=asc)]
+        paged = []
+        cursor = None
+        while True:
+            page = jhhalchemy.model.time_order.get_page(model_cls, asc=asc, cursor=cursor, limit=1)
+            paged.extend(tom.name_id for tom in page.models)
+            cursor = page.cursor
+            if cursor is None:
+                break
+        assert paged == expected
+
+    #
+    # Cursors are only valid for the direction they were made for
+    #
+    page = jhhalchemy.model.time_order.get_page(model_cls, limit=1)
+    with pytest.raises(jhhalchemy.model.time_order.InvalidCursor):
+        jhhalchemy.model.time_order.get_page(model_cls, asc=True, cursor=page.cursor)
+
+
+def test_iter_by_range(model):
+    """
+    Verify streaming batches match get_by_range
+
+    :param model: test model fixture
+    """
+    model_cls = model.__class__
+    expected = [(tom.name_id, tom.time_order) for tom in jhhalchemy.model.time_order.get_by_range(model_cls)]
+    stats = jhhalchemy.model.time_order.StreamStats()
+    batches = list(jhhalchemy.model.time_order.iter_by_range(model_cls, batch_size=2, raw=True, stats=stats))
+    assert [len(batch) for batch in batches] == [2, 1]
+    assert [(row.name_id, row.time_order) for batch in batches for row in batch] == expected
+    assert stats.rows == 3
+    assert stats.peak_batch == 2
+
+
+def test_read_as_of(model):
+    """
+    Verify point in time lookups
+
+    :param model: test model fixture
+    """
+    cls = model.__class__
+    assert cls.read_as_of(25).name == '2'
+    assert cls.read_as_of(20, cls.name != '2').name == '1'
+    assert cls.read_as_of(0) is None
+
+    models = cls.read_as_of_many(cls.name, ['1', '2', 'missing'], 15)
+    assert models['1'].name == '1'
+    assert models['2'] is None
+    assert models['missing'] is None
+
+
+def test_get_by_range_many(model):
+    """
+    Verify multi-key reads match per-key get_by_range
+
+    :param model: test model fixture
+    """
+    model_cls = model.__class__
+    names = ['1', '2', '3', 'missing']
+    grouped = jhhalchemy.model.time_order.get_by_range_many(model_cls, model_cls.name, names, batch_size=2)
+    assert list(grouped) == names
+    for name in names:
+        expected = jhhalchemy.model.time_order.get_by_range(model_cls, model_cls.name == name).all()
+        assert grouped[name] == expected
+
+
+def test_partitions(db):
+    """
+    Verify partitioned tables roll forward, prune range reads and drop old partitions
+
+    :param db: flask_sqlalchemy object fixture
+    """
+    class PartitionedModel(db.Model, jhhalchemy.model.time_order.TimeOrderMixin):
+        __time_order_partitioned__ = True
+        pm_id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True, autoincrement=True)
+        time_order = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True, autoincrement=False)
+
+    db.create_all()
+    connect_str = str(db.engine.url)
+    table_name = PartitionedModel.__table__.name
+    assert jhhalchemy.migrate.roll_partitions(connect_str, table_name, 100, ahead=1, now=1050) == [1000, 1100]
+    assert jhhalchemy.migrate.roll_partitions(connect_str, table_name, 100, ahead=2, now=1050) == [1200]
+    for timestamp in (950, 1050, 1150):
+        PartitionedModel(timestamp=timestamp).save(db.session)
+
+    query = PartitionedModel.read_time_range(start_timestamp=1100, end_timestamp=1150)
+    assert [model.timestamp for model in query] == [1150]
+    assert jhhalchemy.migrate.explain_partitions(query) == {table_name: ['p1100']}
+
+    db.session.commit()
+    assert jhhalchemy.migrate.drop_partitions(connect_str, table_name, 1100) == ['p1000', 'p_old']
+    assert [model.timestamp for model in PartitionedModel.read(removed=True)] == [1150]
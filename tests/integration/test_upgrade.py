@@ -89,3 +89,19 @@ def test_upgrade(dbname, connect_str, db, model):
     assert dt.dt_id != 1
     dt.save(db.session)
     assert dt.dt_id == 1
+
+
+def test_upgrade_lock(dbname, connect_str, db):
+    """
+    Verify a second process waiting for the upgrade lock times out at its deadline, and gets it once it's released.
+
+    :param dbname: test db name
+    :param connect_str: test db connection string
+    :param db: flask_sqlalchemy db object
+    """
+    with jhhalchemy.migrate.get_upgrade_lock(dbname, connect_str):
+        with pytest.raises(jhhalchemy.migrate.LockTimeout):
+            with jhhalchemy.migrate.get_upgrade_lock(dbname, connect_str, timeout=1, deadline=1):
+                pass
+    with jhhalchemy.migrate.get_upgrade_lock(dbname, connect_str, deadline=1) as lock:
+        assert lock
@@ -0,0 +1,35 @@
+"""
+Shared fixtures for the unit tests
+"""
+import jhhalchemy.model
+import jhhalchemy.model.time_order
+import pytest
+import sqlalchemy
+import sqlalchemy.ext.declarative
+
+
+@pytest.fixture(scope='session')
+def make_model():
+    """
+    :return: function that creates a mapped model class that inherits from Base, on its own metadata, without a DB or
+        flask app. It takes the table name, the mixin classes and the class attributes (columns, options).
+    """
+    def make(tablename, *mixins, **attributes):
+        model = sqlalchemy.ext.declarative.declarative_base(cls=jhhalchemy.model.Base)
+        attributes['__tablename__'] = tablename
+        return type(str(tablename.title().replace('_', '')), (model,) + mixins, attributes)
+    return make
+
+
+@pytest.fixture(scope='module')
+def model_cls(make_model):
+    """
+    Create a mapped TimeOrder model class without a DB or flask app.
+
+    :param make_model: model class factory
+    :return: model class
+    """
+    return make_model(
+        'time_order_model', jhhalchemy.model.time_order.TimeOrderMixin,
+        name_id=sqlalchemy.Column('id', sqlalchemy.Integer, primary_key=True),
+        uid=sqlalchemy.Column(sqlalchemy.Integer))
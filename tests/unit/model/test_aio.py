@@ -0,0 +1,92 @@
+"""
+Unit tests for the asyncio helpers. Skipped on SQLAlchemy versions without asyncio support.
+"""
+import pytest
+
+pytest.importorskip('sqlalchemy.ext.asyncio')
+
+import asyncio  # noqa: E402
+import jhhalchemy.model  # noqa: E402
+import jhhalchemy.model.aio  # noqa: E402
+import jhhalchemy.model.time_order  # noqa: E402
+import mock  # noqa: E402
+
+
+def literal_sql(statement):
+    """
+    :param statement: SQLAlchemy Select
+    :return: SQL string with the bound values inlined, on one line
+    """
+    return ' '.join(str(statement.compile(compile_kwargs={'literal_binds': True})).split())
+
+
+def test_read_statements(model_cls):
+    """
+    Verify soft-delete filtering and tagging
+
+    :param model_cls: mapped model class
+    """
+    statement = jhhalchemy.model.aio.read_by_statement(model_cls, uid=1)
+    assert 'WHERE time_order_model.uid = 1 AND time_order_model.time_removed = 0' in literal_sql(statement)
+    assert statement.get_execution_options() == {'jhhalchemy_model': 'TimeOrderModel', 'jhhalchemy_helper': 'read_by'}
+    assert 'WHERE' not in literal_sql(jhhalchemy.model.aio.read_by_statement(model_cls, removed=True))
+
+    statement = jhhalchemy.model.aio.read_statement(model_cls, model_cls.uid > 1)
+    assert 'WHERE time_order_model.time_removed = 0 AND time_order_model.uid > 1' in literal_sql(statement)
+    assert 'time_removed = 0' not in literal_sql(
+        jhhalchemy.model.aio.read_statement(model_cls, model_cls.uid > 1, removed=True))
+
+
+def test_get_by_range_statement(model_cls):
+    """
+    Verify the time range criteria and ordering match get_by_range
+
+    :param model_cls: mapped model class
+    """
+    statement = jhhalchemy.model.aio.get_by_range_statement(
+        model_cls, model_cls.uid == 1, start_timestamp=10, end_timestamp=20)
+    assert literal_sql(statement).endswith(
+        'WHERE time_order_model.time_removed = 0 AND time_order_model.uid = 1 AND time_order_model.time_order <= -10 '
+        'AND time_order_model.time_order >= -20 ORDER BY time_order_model.time_order')
+    assert statement.get_execution_options() == {
+        'jhhalchemy_model': 'TimeOrderModel', 'jhhalchemy_helper': 'get_by_range'}
+
+    statement = jhhalchemy.model.aio.get_by_range_statement(model_cls, asc=True)
+    assert literal_sql(statement).endswith('ORDER BY time_order_model.time_order DESC')
+
+    with pytest.raises(jhhalchemy.model.time_order.InvalidTimestampRange):
+        jhhalchemy.model.aio.get_by_range_statement(model_cls, start_timestamp=20, end_timestamp=10)
+
+
+def test_read(model_cls):
+    """
+    Verify the read helpers execute their statement and return the models
+
+    :param model_cls: mapped model class
+    """
+    session = mock.Mock(execute=mock.AsyncMock(return_value=mock.Mock()))
+    models = asyncio.run(jhhalchemy.model.aio.get_by_range(session, model_cls, start_timestamp=10))
+    assert models == session.execute.return_value.scalars.return_value.all.return_value
+    assert 'time_order_model.time_order <= -10' in literal_sql(session.execute.call_args[0][0])
+
+
+def test_save_delete(model_cls):
+    """
+    Verify save and delete commit and apply soft-delete logic
+
+    :param model_cls: mapped model class
+    """
+    session = mock.Mock(commit=mock.AsyncMock(), delete=mock.AsyncMock())
+    model = model_cls()
+    asyncio.run(jhhalchemy.model.aio.save(session, model))
+    session.add.assert_called_once_with(model)
+    session.commit.assert_awaited_once_with()
+
+    asyncio.run(jhhalchemy.model.aio.delete(session, model, commit=False))
+    assert model.time_removed is not None
+    assert session.commit.await_count == 1
+    session.delete.assert_not_called()
+
+    asyncio.run(jhhalchemy.model.aio.delete(session, model, soft=False))
+    session.delete.assert_awaited_once_with(model)
+    assert session.commit.await_count == 2
@@ -0,0 +1,146 @@
+"""
+Unit tests for archiving
+"""
+import jhhalchemy.model
+import jhhalchemy.model.archive
+import jhhalchemy.model.time_order
+import mock
+import pytest
+import sqlalchemy
+import sqlalchemy.ext.declarative
+
+
+@pytest.fixture(scope='module')
+def model_cls(make_model):
+    """
+    Create a mapped TimeOrder model class with an archive table
+
+    :param make_model: model class factory
+    :return: model class
+    """
+    return make_model(
+        'archived_model', jhhalchemy.model.time_order.TimeOrderMixin,
+        __archive__=True,
+        name_id=sqlalchemy.Column('id', sqlalchemy.Integer, primary_key=True),
+        uid=sqlalchemy.Column(sqlalchemy.Integer))
+
+
+def literal_sql(clause):
+    """
+    :param clause: SQLAlchemy clause
+    :return: SQL string with the bound values inlined, on one line
+    """
+    return ' '.join(str(clause.compile(compile_kwargs={'literal_binds': True})).split())
+
+
+def test_archive_table(model_cls):
+    """
+    Verify the archive table copies the columns without autoincrement
+
+    :param model_cls: mapped model class
+    """
+    archive = model_cls.__archive_table__
+    assert archive.name == 'archived_model_archive'
+    assert archive.metadata is model_cls.__table__.metadata
+    assert [column.name for column in archive.columns] == [column.name for column in model_cls.__table__.columns]
+    assert [column.name for column in archive.primary_key] == ['id']
+    assert archive.c.id.autoincrement is False
+    assert jhhalchemy.model.Base.__archive_table__ is None
+
+
+def test_read_archived(model_cls):
+    """
+    Verify read unions the archive with the criteria applied to both tables
+
+    :param model_cls: mapped model class
+    """
+    with mock.patch.object(model_cls, 'query', sqlalchemy.orm.Query(model_cls)):
+        sql = literal_sql(model_cls.read(model_cls.uid == 1, archived=True).statement)
+    assert 'FROM archived_model WHERE archived_model.time_removed = 0 AND archived_model.uid = 1 UNION ALL' in sql
+    assert sql.endswith(
+        'FROM archived_model_archive WHERE archived_model_archive.time_removed = 0 AND archived_model_archive.uid = 1'
+        ') AS archived_model_all')
+
+    model = sqlalchemy.ext.declarative.declarative_base(cls=jhhalchemy.model.Base)
+
+    class HotModel(model):
+        __tablename__ = 'hot_model'
+        name_id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+
+    with pytest.raises(ValueError):
+        HotModel.read(archived=True)
+
+
+def test_archive_criterion(model_cls):
+    """
+    Verify soft-deleted and aged rows are selected
+
+    :param model_cls: mapped model class
+    """
+    assert literal_sql(jhhalchemy.model.archive.archive_criterion(model_cls, removed_before=100, older_than=50)) == (
+        'archived_model.time_removed != 0 AND archived_model.time_removed < 100 OR archived_model.time_order > -50')
+    with pytest.raises(ValueError):
+        jhhalchemy.model.archive.archive_criterion(model_cls)
+
+
+def test_file_checkpoint(tmpdir):
+    """
+    Verify checkpoints are saved, loaded and cleared
+
+    :param tmpdir: pytest temporary directory
+    """
+    checkpoint = jhhalchemy.model.archive.FileCheckpoint(str(tmpdir.join('checkpoint.json')))
+    assert checkpoint.load() is None
+    checkpoint.save(10)
+    assert checkpoint.load() == 10
+    checkpoint.clear()
+    assert checkpoint.load() is None
+    checkpoint.clear()
+
+
+@mock.patch('time.sleep', autospec=True)
+def test_archive(mock_sleep, model_cls):
+    """
+    Verify each batch is locked, copied and deleted in one transaction, with checkpoints
+
+    :param mock_sleep: mocked time.sleep
+    :param model_cls: mapped model class
+    """
+    session = mock.Mock()
+    checkpoint = mock.Mock()
+    checkpoint.load.return_value = 5
+    keys = session.query.return_value.filter.return_value.with_for_update.return_value.all
+    keys.side_effect = [[(6,), (8,)], [(9,)]]
+    with mock.patch.object(model_cls, '_primary_key_batches', return_value=iter([[6, 8], [9]])) as mock_batches:
+        result = jhhalchemy.model.archive.archive(
+            session, model_cls, removed_before=100, batch_size=2, sleep_seconds=1, checkpoint=checkpoint)
+    assert (result.rows, result.batches) == (3, 2)
+    criteria = mock_batches.call_args[0][1]
+    assert [literal_sql(criterion) for criterion in criteria] == [
+        'archived_model.time_removed != 0 AND archived_model.time_removed < 100', 'archived_model.id > 5']
+    assert mock_batches.call_args[0][2] == 2
+
+    statements = [literal_sql(call[0][0]) for call in session.execute.call_args_list]
+    assert statements[0] == (
+        'INSERT INTO archived_model_archive (time_removed, time_created, time_modified, time_order, id, uid) '
+        'SELECT archived_model.time_removed, archived_model.time_created, archived_model.time_modified, '
+        'archived_model.time_order, archived_model.id, archived_model.uid FROM archived_model '
+        'WHERE archived_model.id IN (6, 8)')
+    assert statements[1] == 'DELETE FROM archived_model WHERE archived_model.id IN (6, 8)'
+    assert statements[3] == 'DELETE FROM archived_model WHERE archived_model.id IN (9)'
+    assert session.commit.call_count == 2
+    checkpoint.save.assert_has_calls([mock.call(8), mock.call(9)])
+    checkpoint.clear.assert_called_once_with()
+    assert mock_sleep.call_count == 2
+
+    #
+    # Dry runs only count
+    #
+    session.reset_mock()
+    session.query.return_value.filter.return_value.count.return_value = 4
+    with mock.patch.object(model_cls, '_primary_key_batches', return_value=iter([[1, 4]])):
+        result = jhhalchemy.model.archive.archive(
+            session, model_cls, older_than=50, checkpoint=checkpoint, dry_run=True)
+    assert (result.rows, result.batches) == (4, 1)
+    assert not session.execute.called
+    assert not session.commit.called
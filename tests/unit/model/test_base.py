@@ -4,6 +4,11 @@ Unit tests for the Base model
 import jhhalchemy.model
 import mock
 import pytest
+import sqlalchemy
+import sqlalchemy.dialects.mysql
+import sqlalchemy.event
+import sqlalchemy.ext.declarative
+import sqlalchemy.orm
 
 
 @pytest.fixture
@@ -11,6 +16,32 @@ def base_instance():
     return jhhalchemy.model.Base()
 
 
+@pytest.fixture(scope='module')
+def model_cls(make_model):
+    """
+    Create a mapped model class that inherits from Base without a DB or flask app.
+
+    :param make_model: model class factory
+    :return: model class
+    """
+    return make_model(
+        'name_model',
+        name_id=sqlalchemy.Column(sqlalchemy.Integer, primary_key=True),
+        name=sqlalchemy.Column(sqlalchemy.String(255)))
+
+
+def mysql_sql(stmt, params=None):
+    """
+    Compile a statement for MySQL.
+
+    :param stmt: SQLAlchemy statement
+    :param params: parameters the statement is executed with, they determine an INSERT's columns
+    :return: SQL string
+    """
+    column_keys = list(params) if params else None
+    return str(stmt.compile(dialect=sqlalchemy.dialects.mysql.dialect(), column_keys=column_keys))
+
+
 def test_base_save(base_instance):
     """
     Verify add and commit to DB.
@@ -35,6 +66,104 @@ def test_base_save(base_instance):
     assert not session.commit.called
 
 
+def test_soft_delete_index(model_cls):
+    """
+    Verify the optional soft-delete index
+
+    :param model_cls: mapped model class without the option
+    """
+    assert not model_cls.__table__.indexes
+    model = sqlalchemy.ext.declarative.declarative_base(cls=jhhalchemy.model.Base)
+
+    class IndexedModel(model):
+        __tablename__ = 'indexed_model'
+        __soft_delete_index__ = ('name',)
+        name_id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+        name = sqlalchemy.Column(sqlalchemy.String(255))
+
+    indexes = dict((index.name, [column.name for column in index.columns]) for index in IndexedModel.__table__.indexes)
+    assert indexes == {'ix_indexed_model_soft_delete': ['name', 'time_removed']}
+
+
+def test_chunks():
+    """
+    Verify chunking of generators and lists
+    """
+    assert list(jhhalchemy.model._chunks([], 2)) == []
+    assert list(jhhalchemy.model._chunks(range(5), 2)) == [[0, 1], [2, 3], [4]]
+    assert list(jhhalchemy.model._chunks((i for i in range(4)), 2)) == [[0, 1], [2, 3]]
+
+
+def test_base_save_many(model_cls):
+    """
+    Verify chunked executemany inserts and commits.
+
+    :param model_cls: mapped model class
+    """
+    session = mock.Mock()
+    session.execute.return_value.rowcount = 2
+    rows = [{'name': 'a'}, {'name': 'b'}, {'name': 'c'}]
+
+    #
+    # One execute and one commit per chunk. Server defaults are left out of the INSERT.
+    #
+    results = model_cls.save_many(session, iter(rows), chunk_size=2)
+    assert [result.rows for result in results] == [2, 1]
+    assert all(result.seconds >= 0 for result in results)
+    assert session.execute.call_count == 2
+    assert session.commit.call_count == 2
+    stmt, chunk = session.execute.call_args_list[0][0]
+    assert chunk == rows[:2]
+    sql = mysql_sql(stmt, chunk[0])
+    assert sql.startswith('INSERT INTO name_model')
+    assert 'time_created' not in sql
+    assert 'time_removed' not in sql
+
+    #
+    # No rows, no commit
+    #
+    session.reset_mock()
+    assert model_cls.save_many(session, []) == []
+    assert not session.execute.called
+    assert not session.commit.called
+
+    #
+    # No commit
+    #
+    session.reset_mock()
+    model_cls.save_many(session, rows, commit=False)
+    session.execute.assert_called_once_with(mock.ANY, rows)
+    assert not session.commit.called
+
+
+def test_base_save_many_upsert(model_cls):
+    """
+    Verify the ON DUPLICATE KEY UPDATE clause
+
+    :param model_cls: mapped model class
+    """
+    session = mock.Mock()
+
+    #
+    # Update every non-key column except time_created
+    #
+    model_cls.save_many(session, [{'name_id': 1, 'name': 'a', 'time_created': 5}], upsert=True)
+    stmt, chunk = session.execute.call_args[0]
+    sql = mysql_sql(stmt, chunk[0])
+    assert 'ON DUPLICATE KEY UPDATE name = VALUES(name)' in sql
+    assert 'name_id = VALUES(name_id)' not in sql
+    assert 'time_created = VALUES' not in sql
+
+    #
+    # Only keys -> no-op update
+    #
+    session.reset_mock()
+    model_cls.save_many(session, [{'name_id': 1}], upsert=True)
+    stmt, chunk = session.execute.call_args[0]
+    sql = mysql_sql(stmt, chunk[0])
+    assert 'ON DUPLICATE KEY UPDATE name_id = VALUES(name_id)' in sql
+
+
 @mock.patch('jhhalchemy.model.Base.query', autospec=True)
 def test_base_read_by(mock_query):
     """
@@ -107,3 +236,186 @@ def test_base_delete(mock_ut, base_instance):
     assert not mock_ut.called
     mock_session.delete.assert_called_once_with(base_instance)
     assert not mock_session.commit.called
+
+
+def test_base_delete_where(model_cls):
+    """
+    Verify batched soft and hard deletes bounded by primary key ranges
+
+    :param model_cls: mapped model class
+    """
+    session = mock.Mock()
+    key_query = mock.Mock()
+    key_query.filter.return_value = key_query
+    row_query = mock.Mock()
+    row_query.filter.return_value = row_query
+    session.query.side_effect = lambda entity: row_query if entity is model_cls else key_query
+
+    #
+    # Soft delete two batches: only rows that are not removed yet, one UPDATE and commit per primary key range
+    #
+    key_query.order_by.return_value.limit.side_effect = [[(1,), (2,)], [(5,)]]
+    row_query.update.side_effect = [2, 1]
+    assert model_cls.delete_where(session, model_cls.name == 'a', batch_size=2) == 3
+    key_query.order_by.return_value.limit.assert_called_with(2)
+    assert str(key_query.filter.call_args_list[2][0][0]) == 'name_model.name_id > :name_id_1'
+    first_range = [str(crit) for crit in row_query.filter.call_args_list[0][0]]
+    assert first_range == [
+        'name_model.name_id >= :name_id_1',
+        'name_model.name_id <= :name_id_1',
+        'name_model.name = :name_1',
+        'name_model.time_removed = :time_removed_1']
+    values = row_query.update.call_args[0][0]
+    assert str(values[model_cls.time_removed]) == 'unix_timestamp()'
+    assert row_query.update.call_count == 2
+    assert not row_query.delete.called
+    assert session.commit.call_count == 2
+
+    #
+    # Hard delete, no commit, includes soft-deleted rows
+    #
+    session.reset_mock()
+    row_query.reset_mock()
+    key_query.order_by.return_value.limit.side_effect = [[(1,)]]
+    row_query.delete.return_value = 1
+    assert model_cls.delete_where(session, model_cls.name == 'a', soft=False, commit=False) == 1
+    assert [str(crit) for crit in row_query.filter.call_args[0]][2:] == ['name_model.name = :name_1']
+    row_query.delete.assert_called_once_with(synchronize_session=False)
+    assert not session.commit.called
+
+    #
+    # Nothing to delete
+    #
+    row_query.reset_mock()
+    key_query.order_by.return_value.limit.side_effect = [[]]
+    assert model_cls.delete_where(session) == 0
+    assert not row_query.update.called
+
+
+def test_base_delete_where_composite(make_model, tmpdir):
+    """
+    Verify composite primary keys are paged on the whole key, so each DELETE covers at most batch_size rows
+
+    :param make_model: model class factory
+    :param tmpdir: pytest temporary directory
+    """
+    model_cls = make_model(
+        'composite_model',
+        uid=sqlalchemy.Column(sqlalchemy.Integer, primary_key=True, autoincrement=False),
+        time_order=sqlalchemy.Column(sqlalchemy.Integer, primary_key=True, autoincrement=False))
+    engine = sqlalchemy.create_engine('sqlite:///{}'.format(tmpdir.join('composite.db')))
+    table = sqlalchemy.Table('composite_model', sqlalchemy.MetaData(), *[
+        sqlalchemy.Column(column.name, column.type, primary_key=column.primary_key)
+        for column in model_cls.__table__.columns])
+    table.create(engine)
+    engine.execute(table.insert(), [
+        {'uid': uid, 'time_order': time_order, 'time_removed': 0, 'time_created': 0}
+        for uid in (1, 2) for time_order in (-3, -2, -1)])
+    deletes = []
+
+    @sqlalchemy.event.listens_for(engine, 'after_cursor_execute')
+    def count_deleted(conn, cursor, statement, *args):
+        if statement.startswith('DELETE'):
+            deletes.append(cursor.rowcount)
+
+    session = sqlalchemy.orm.sessionmaker(bind=engine)()
+
+    batches = list(model_cls._primary_key_batches(session, [], 4))
+    assert batches == [[(1, -3), (1, -2), (1, -1), (2, -3)], [(2, -2), (2, -1)]]
+    assert model_cls.delete_where(session, model_cls.time_order < 0, soft=False, batch_size=2) == 6
+    assert deletes == [2, 2, 2]
+    engine.dispose()
+
+
+def test_base_get(model_cls):
+    """
+    Verify primary key lookups apply the soft-delete logic in Python
+
+    :param model_cls: mapped model class
+    """
+    with mock.patch.object(model_cls, 'query') as mock_query:
+        mock_query.get.return_value = model_cls(name_id=1, time_removed=0)
+        assert model_cls.get(1) is mock_query.get.return_value
+        mock_query.get.assert_called_once_with(1)
+
+        #
+        # Soft-deleted, or about to be
+        #
+        mock_query.get.return_value = model_cls(name_id=1, time_removed=10)
+        assert model_cls.get(1) is None
+        assert model_cls.get(1, removed=True) is mock_query.get.return_value
+        mock_query.get.return_value = model_cls(name_id=1, time_removed=sqlalchemy.func.unix_timestamp())
+        assert model_cls.get(1) is None
+
+        mock_query.get.return_value = None
+        assert model_cls.get(1) is None
+
+
+def test_base_get_many(model_cls):
+    """
+    Verify the identity map is used first and only missing keys are queried
+
+    :param model_cls: mapped model class
+    """
+    def identity(pk):
+        return model_cls.__mapper__.identity_key_from_primary_key((pk,))
+
+    loaded = model_cls(name_id=1, time_removed=0)
+    removed = model_cls(name_id=2, time_removed=10)
+    fetched = [model_cls(name_id=4, time_removed=0), model_cls(name_id=3, time_removed=0)]
+    with mock.patch.object(model_cls, 'query') as mock_query, \
+            mock.patch.object(model_cls, 'read', autospec=True) as mock_read:
+        mock_query.session.identity_map = {identity(1): loaded, identity(2): removed}
+        mock_read.side_effect = [fetched[:1], fetched[1:]]
+        models = model_cls.get_many([3, 2, 1, 4, 5], chunk_size=2)
+        assert list(models.items()) == [(3, fetched[1]), (1, loaded), (4, fetched[0])]
+        assert mock_read.call_count == 2
+        criteria = [call[0][0].compile(compile_kwargs={'literal_binds': True}) for call in mock_read.call_args_list]
+        assert [str(crit) for crit in criteria] == ['name_model.name_id IN (3, 4)', 'name_model.name_id IN (5)']
+        assert mock_read.call_args[1] == {'removed': False}
+
+        #
+        # Include soft-deleted rows
+        #
+        mock_read.reset_mock()
+        mock_read.side_effect = None
+        mock_read.return_value = []
+        models = model_cls.get_many([2], removed=True)
+        assert list(models.items()) == [(2, removed)]
+        assert not mock_read.called
+
+
+def test_base_get_many_expired(model_cls, tmpdir):
+    """
+    Verify instances expired by a commit are reloaded with the IN query rather than one query each
+
+    :param model_cls: mapped model class
+    :param tmpdir: pytest temporary directory
+    """
+    engine = sqlalchemy.create_engine('sqlite:///{}'.format(tmpdir.join('expired.db')))
+    sqlalchemy.Table('name_model', sqlalchemy.MetaData(), *[
+        sqlalchemy.Column(column.name, column.type, primary_key=column.primary_key)
+        for column in model_cls.__table__.columns]).create(engine)
+    statements = []
+
+    @sqlalchemy.event.listens_for(engine, 'before_cursor_execute')
+    def count_statements(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    session = sqlalchemy.orm.sessionmaker(bind=engine)()
+    with mock.patch.object(model_cls, 'query', session.query(model_cls)):
+        added = [model_cls(name_id=pk, name=str(pk), time_removed=0, time_created=0) for pk in (1, 2, 3)]
+        session.add_all(added)
+        session.commit()
+        del statements[:]
+        models = model_cls.get_many([1, 2, 3])
+        assert list(models.values()) == added
+        assert [model.name for model in models.values()] == ['1', '2', '3']
+        assert len(statements) == 1
+
+        #
+        # Loaded instances are used without a query
+        #
+        model_cls.get_many([1, 2, 3])
+        assert len(statements) == 1
+    engine.dispose()
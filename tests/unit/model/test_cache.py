@@ -0,0 +1,233 @@
+"""
+Unit tests for the model cache
+"""
+import jhhalchemy.model
+import jhhalchemy.model.cache
+import mock
+import pytest
+import sqlalchemy
+import sqlalchemy.orm
+
+
+@pytest.fixture
+def cache():
+    return jhhalchemy.model.cache.ModelCache(jhhalchemy.model.cache.LocalBackend(max_size=2), ttl=60)
+
+
+@pytest.fixture
+def model_cls(make_model, cache):
+    """
+    Create a mapped model class with caching enabled
+
+    :param make_model: model class factory
+    :param cache: ModelCache fixture
+    :return: model class
+    """
+    return make_model(
+        'cached_model',
+        __cache__=cache,
+        name_id=sqlalchemy.Column(sqlalchemy.Integer, primary_key=True),
+        name=sqlalchemy.Column(sqlalchemy.String(255)))
+
+
+@mock.patch('time.time', autospec=True)
+def test_local_backend(mock_time):
+    """
+    Verify LRU eviction and TTL expiration
+
+    :param mock_time: mocked time.time
+    """
+    mock_time.return_value = 100
+    backend = jhhalchemy.model.cache.LocalBackend(max_size=2)
+    backend.set('a', 1, 10)
+    backend.set('b', 2, 10)
+
+    #
+    # Reading a makes b the least recently used
+    #
+    assert backend.get('a') == 1
+    backend.set('c', 3, 10)
+    assert backend.get('b') is None
+    assert backend.get('a') == 1
+    assert backend.get('c') == 3
+    assert backend.evictions == 1
+
+    #
+    # Expired and deleted entries are misses
+    #
+    backend.delete('c')
+    assert backend.get('c') is None
+    mock_time.return_value = 111
+    assert backend.get('a') is None
+
+
+def test_get(cache, model_cls):
+    """
+    Verify primary key read-through and invalidation
+
+    :param cache: ModelCache fixture
+    :param model_cls: mapped model class
+    """
+    loader = mock.Mock(return_value=model_cls(name_id=1, name='a', time_removed=0))
+
+    #
+    # Miss loads and caches, hit rebuilds a detached instance without the loader
+    #
+    assert cache.get(model_cls, 1, loader) is loader.return_value
+    hit = cache.get(model_cls, 1, loader)
+    loader.assert_called_once_with()
+    assert hit is not loader.return_value
+    assert (hit.name_id, hit.name) == (1, 'a')
+    assert sqlalchemy.inspect(hit).detached
+    assert sqlalchemy.inspect(hit).identity == (1,)
+    assert cache.stats() == {'hits': 1, 'misses': 1, 'evictions': 0}
+
+    #
+    # Not found is not cached
+    #
+    loader = mock.Mock(return_value=None)
+    assert cache.get(model_cls, 2, loader) is None
+    assert cache.get(model_cls, 2, loader) is None
+    assert loader.call_count == 2
+
+    #
+    # Invalidate the row
+    #
+    loader = mock.Mock(return_value=model_cls(name_id=1, name='b'))
+    cache.invalidate_model(hit)
+    assert cache.get(model_cls, 1, loader).name == 'b'
+    loader.assert_called_once_with()
+
+
+def test_query(cache, model_cls):
+    """
+    Verify read_by entries are keyed by arguments and dropped with the generation
+
+    :param cache: ModelCache fixture
+    :param model_cls: mapped model class
+    """
+    loader = mock.Mock(return_value=[model_cls(name_id=1, name='a')])
+    assert cache.query(model_cls, {'name': 'a', 'removed': False}, loader) == loader.return_value
+    assert [model.name_id for model in cache.query(model_cls, {'removed': False, 'name': 'a'}, loader)] == [1]
+    loader.assert_called_once_with()
+
+    #
+    # Different arguments are a different entry
+    #
+    cache.query(model_cls, {'name': 'a', 'removed': True}, loader)
+    assert loader.call_count == 2
+
+    #
+    # Any change to the table starts a new generation
+    #
+    cache.invalidate(model_cls)
+    cache.query(model_cls, {'name': 'a', 'removed': False}, loader)
+    assert loader.call_count == 3
+
+
+def test_base_read_cached(cache, model_cls):
+    """
+    Verify the Base helpers go through the cache and apply soft-delete logic
+
+    :param cache: ModelCache fixture
+    :param model_cls: mapped model class
+    """
+    with mock.patch.object(model_cls, 'query') as mock_query:
+        mock_query.session = sqlalchemy.orm.Session()
+        mock_query.get.return_value = model_cls(name_id=1, name='a', time_removed=0)
+        assert model_cls.read_cached(1).name == 'a'
+        assert model_cls.read_cached(1).name == 'a'
+        mock_query.get.assert_called_once_with(1)
+
+        mock_query.get.return_value = model_cls(name_id=2, name='b', time_removed=10)
+        assert model_cls.read_cached(2) is None
+        assert model_cls.read_cached(2, removed=True).name == 'b'
+
+        read_by = mock_query.filter_by.return_value.execution_options.return_value
+        read_by.all.return_value = [model_cls(name_id=1, name='a', time_removed=0)]
+        assert [model.name for model in model_cls.read_by_cached(name='a')] == ['a']
+        assert [model.name for model in model_cls.read_by_cached(name='a')] == ['a']
+        mock_query.filter_by.assert_called_once_with(name='a', time_removed=0)
+
+
+@mock.patch('sqlalchemy.inspect', autospec=True)
+def test_base_invalidation(mock_inspect, model_cls):
+    """
+    Verify save and delete invalidate the cache after committing
+
+    :param mock_inspect: mocked sqlalchemy.inspect
+    :param model_cls: mapped model class
+    """
+    mock_inspect.return_value.identity = (1,)
+    session = mock.Mock()
+    model = model_cls()
+    with mock.patch.object(model_cls.__cache__, 'invalidate', autospec=True) as mock_invalidate:
+        model.save(session)
+        mock_invalidate.assert_called_once_with(model_cls, [(1,)])
+        mock_invalidate.reset_mock()
+        model.delete(session, soft=False)
+        mock_invalidate.assert_called_once_with(model_cls, [(1,)])
+        mock_invalidate.reset_mock()
+        model_cls.save_many(session, [{'name_id': 2, 'name': 'b'}, {'name': 'c'}])
+        mock_invalidate.assert_called_once_with(model_cls, [(2,)], session=None)
+
+
+def test_invalidate_after_commit(cache, model_cls, tmpdir):
+    """
+    Verify uncommitted changes are invalidated again when their session commits or rolls back
+
+    :param cache: ModelCache fixture
+    :param model_cls: mapped model class
+    :param tmpdir: pytest temporary directory
+    """
+    engine = sqlalchemy.create_engine('sqlite:///{}'.format(tmpdir.join('cache.db')))
+    sqlalchemy.Table('cached_model', sqlalchemy.MetaData(), *[
+        sqlalchemy.Column(column.name, column.type, primary_key=column.primary_key)
+        for column in model_cls.__table__.columns]).create(engine)
+    session = sqlalchemy.orm.sessionmaker(bind=engine)()
+    model = model_cls(name_id=1, name='a', time_removed=0, time_created=0)
+    model.save(session)
+
+    #
+    # Another reader caches the committed row before the update commits
+    #
+    model.name = 'b'
+    model.save(session, commit=False)
+    session.flush()
+    cache.get(model_cls, 1, lambda: model_cls(name_id=1, name='a', time_removed=0))
+    session.commit()
+    loader = mock.Mock(return_value=None)
+    assert cache.get(model_cls, 1, loader) is None
+    loader.assert_called_once_with()
+
+    model.delete(session, commit=False, soft=False)
+    assert session.info[jhhalchemy.model.cache.PENDING]
+    with mock.patch.object(cache, 'invalidate', autospec=True) as mock_invalidate:
+        session.rollback()
+        mock_invalidate.assert_called_once_with(model_cls, [(1,)])
+    assert jhhalchemy.model.cache.PENDING not in session.info
+    engine.dispose()
+
+
+def test_read_cached_rollback(model_cls, tmpdir):
+    """
+    Verify a row read through a session with uncommitted changes is not cached, so the rolled back value is not served
+
+    :param model_cls: mapped model class
+    :param tmpdir: pytest temporary directory
+    """
+    engine = sqlalchemy.create_engine('sqlite:///{}'.format(tmpdir.join('cache.db')))
+    sqlalchemy.Table('cached_model', sqlalchemy.MetaData(), *[
+        sqlalchemy.Column(column.name, column.type, primary_key=column.primary_key)
+        for column in model_cls.__table__.columns]).create(engine)
+    session = sqlalchemy.orm.sessionmaker(bind=engine)()
+    with mock.patch.object(model_cls, 'query', session.query(model_cls)):
+        model = model_cls(name_id=1, name='a', time_removed=0, time_created=0)
+        model.save(session)
+        model.name = 'b'
+        model.save(session, commit=False)
+        assert model_cls.read_cached(1).name == 'b'
+        session.rollback()
+        assert model_cls.read_cached(1).name == 'a'
+        assert model_cls.read_cached(1).name == 'a'
+    engine.dispose()
@@ -0,0 +1,162 @@
+"""
+Unit tests for change data capture, against SQLite
+"""
+import jhhalchemy.model
+import jhhalchemy.model.changes
+import json
+import pytest
+import sqlalchemy
+import sqlalchemy.event
+import sqlalchemy.orm
+import time
+
+
+@pytest.fixture(scope='module')
+def model_cls(make_model):
+    """
+    Create a mapped model class with a change stream
+
+    :param make_model: model class factory
+    :return: model class
+    """
+    return make_model(
+        'changed_model',
+        __changes__=jhhalchemy.model.changes.ChangeStream(jhhalchemy.model.changes.QueueSink()),
+        name_id=sqlalchemy.Column('id', sqlalchemy.Integer, primary_key=True),
+        name=sqlalchemy.Column(sqlalchemy.String(20)))
+
+
+@pytest.fixture
+def session(model_cls, tmpdir):
+    """
+    Create a session on a SQLite database with the model's table, without the MySQL server defaults, and
+    unix_timestamp() for soft deletes.
+
+    :param model_cls: mapped model class
+    :param tmpdir: pytest temporary directory
+    :return: session
+    """
+    engine = sqlalchemy.create_engine('sqlite:///{}'.format(tmpdir.join('changes.db')))
+    sqlalchemy.event.listen(
+        engine, 'connect', lambda connection, record: connection.create_function('unix_timestamp', 0, time.time))
+    metadata = sqlalchemy.MetaData()
+    sqlalchemy.Table('changed_model', metadata, *[
+        sqlalchemy.Column(column.name, column.type, primary_key=column.primary_key)
+        for column in model_cls.__table__.columns])
+    jhhalchemy.model.changes.outbox_table(metadata)
+    metadata.create_all(engine)
+    yield sqlalchemy.orm.sessionmaker(bind=engine)()
+    engine.dispose()
+
+
+def events(model_cls):
+    """
+    :param model_cls: model class with a QueueSink change stream
+    :return: the events on the queue
+    """
+    sink_queue = model_cls.__changes__.sink.queue
+    return [sink_queue.get_nowait() for _ in range(sink_queue.qsize())]
+
+
+def test_save_delete(model_cls, session):
+    """
+    Verify inserts, updates and deletes are emitted after commit, with the changed columns
+
+    :param model_cls: mapped model class
+    :param session: SQLite session
+    """
+    model = model_cls(name='a', time_removed=0)
+    model.save(session, commit=False)
+    session.flush()
+    assert events(model_cls) == []
+    session.commit()
+    (insert,) = events(model_cls)
+    assert (insert.table, insert.operation, insert.primary_key) == ('changed_model', 'insert', model.name_id)
+    assert insert.columns == {'name': 'a', 'time_removed': 0}
+
+    model.name = 'b'
+    model.save(session)
+    model.save(session)
+    model.delete(session, soft=False)
+    update, delete = events(model_cls)
+    assert (update.operation, update.columns) == ('update', {'name': 'b'})
+    assert (delete.operation, delete.primary_key, delete.columns) == ('delete', insert.primary_key, {})
+
+
+def test_rollback(model_cls, session):
+    """
+    Verify rolled back changes are not emitted
+
+    :param model_cls: mapped model class
+    :param session: SQLite session
+    """
+    model_cls(name='a', time_removed=0).save(session, commit=False)
+    session.flush()
+    session.rollback()
+    session.commit()
+    assert events(model_cls) == []
+
+
+def test_unflushed(model_cls, session):
+    """
+    Verify changes that were never flushed are dropped at the commit instead of being emitted by a later one
+
+    :param model_cls: mapped model class
+    :param session: SQLite session
+    """
+    model = model_cls(name='a', time_removed=0)
+    model.save(session, commit=False)
+    session.expunge(model)
+    session.commit()
+    assert jhhalchemy.model.changes.PENDING not in session.info
+
+    model_cls(name='b', time_removed=0).save(session)
+    (insert,) = events(model_cls)
+    assert insert.columns['name'] == 'b'
+
+
+def test_sinks(tmpdir):
+    """
+    Verify the callback and file sinks get one batch per call
+
+    :param tmpdir: pytest temporary directory
+    """
+    event = jhhalchemy.model.changes.ChangeEvent('t', 'insert', 1, {'name': 'a'}, 10.0)
+    batches = []
+    jhhalchemy.model.changes.CallbackSink(batches.append).emit([event, event])
+    assert batches == [[event, event]]
+
+    path = str(tmpdir.join('events.jsonl'))
+    sink = jhhalchemy.model.changes.FileSink(path)
+    sink.emit([event])
+    sink.emit([event])
+    with open(path) as events_file:
+        assert [json.loads(line)['columns'] for line in events_file] == [{'name': 'a'}, {'name': 'a'}]
+
+
+def test_outbox(model_cls, session):
+    """
+    Verify the outbox is written in the change's transaction and drained in order
+
+    :param model_cls: mapped model class
+    :param session: SQLite session
+    """
+    outbox = jhhalchemy.model.changes.OutboxSink(jhhalchemy.model.changes.outbox_table(sqlalchemy.MetaData()))
+    stream = model_cls.__changes__
+    model_cls.__changes__ = jhhalchemy.model.changes.ChangeStream(outbox)
+    try:
+        model_cls(name='lost', time_removed=0).save(session, commit=False)
+        session.flush()
+        session.rollback()
+        first = model_cls(name='a', time_removed=0)
+        first.save(session)
+        first.delete(session)
+    finally:
+        model_cls.__changes__ = stream
+
+    batches = []
+    assert outbox.drain(session, batches.append, batch_size=1) == 2
+    assert [[(event.operation, event.primary_key) for event in batch] for batch in batches] == [
+        [('insert', first.name_id)], [('soft_delete', first.name_id)]]
+    assert batches[1][0].columns == {'time_removed': None}
+    assert outbox.drain(session, batches.append) == 0
@@ -0,0 +1,120 @@
+"""
+Unit tests for read replica routing, against SQLite databases standing in for the primary and replicas
+"""
+import flask
+import jhhalchemy.model
+import jhhalchemy.model.replica
+import pytest
+import sqlalchemy
+import sqlalchemy.exc
+
+
+@pytest.fixture
+def db(tmpdir):
+    """
+    Create a ReplicaSQLAlchemy with two replicas
+
+    :param tmpdir: pytest temporary directory
+    :return: ReplicaSQLAlchemy
+    """
+    app = flask.Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///{}'.format(tmpdir.join('primary.db'))
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    replicas = ['sqlite:///{}'.format(tmpdir.join('replica_{}.db'.format(i))) for i in range(2)]
+    replica_db = jhhalchemy.model.replica.ReplicaSQLAlchemy(app, replicas=replicas, model_class=jhhalchemy.model.Base)
+    yield replica_db
+    replica_db.session.remove()
+
+
+@pytest.fixture
+def table():
+    """
+    :return: table to build statements on
+    """
+    return sqlalchemy.Table('replicated', sqlalchemy.MetaData(), sqlalchemy.Column('id', sqlalchemy.Integer))
+
+
+def test_get_bind(db, table):
+    """
+    Verify each transaction's SELECTs go to one replica, taken in turn, and writes, locking reads and using_primary go
+    to the primary
+
+    :param db: ReplicaSQLAlchemy fixture
+    :param table: test table
+    """
+    session = db.session()
+    select = sqlalchemy.select([table])
+    binds = []
+    for _ in range(3):
+        binds.extend([session.get_bind(clause=select), session.get_bind(clause=select)])
+        session.commit()
+    assert binds == [db.replicas[0]] * 2 + [db.replicas[1]] * 2 + [db.replicas[0]] * 2
+    session.get_bind(clause=select)
+    session.rollback()
+    assert jhhalchemy.model.replica.REPLICA not in session.info
+    with jhhalchemy.model.replica.using_primary():
+        assert session.get_bind(clause=select) is db.engine
+    assert session.get_bind() is db.engine
+    assert session.get_bind(clause=select) in db.replicas
+
+    #
+    # Locking reads are about to write, so they stick like writes
+    #
+    assert session.get_bind(clause=select.with_for_update()) is db.engine
+    assert session.get_bind(clause=select) is db.engine
+
+
+def test_sticky(db, table):
+    """
+    Verify a session reads from the primary for sticky_seconds after it writes
+
+    :param db: ReplicaSQLAlchemy fixture
+    :param table: test table
+    """
+    session = db.session()
+    select = sqlalchemy.select([table])
+    assert session.get_bind(clause=table.insert()) is db.engine
+    assert session.get_bind(clause=select) is db.engine
+
+    session.info[jhhalchemy.model.replica.PRIMARY_UNTIL] = 0
+    assert session.get_bind(clause=select) in db.replicas
+
+    #
+    # Flushes stick too
+    #
+    table.create(db.engine)
+    session.execute(table.insert().values(id=1))
+    session.commit()
+    session.info[jhhalchemy.model.replica.PRIMARY_UNTIL] = 0
+    jhhalchemy.model.replica._stick_after_flush(session, None)
+    assert session.get_bind(clause=select) is db.engine
+
+    db.sticky_seconds = 0
+    session.stick_to_primary()
+    assert session.get_bind(clause=select) in db.replicas
+
+
+def test_least_latency(db, table):
+    """
+    Verify LeastLatency tries unmeasured replicas first, then the fastest, and is fed by the replica engines
+
+    :param db: ReplicaSQLAlchemy fixture
+    :param table: test table
+    """
+    a, b = db.replicas
+    selector = jhhalchemy.model.replica.LeastLatency(alpha=0.5)
+    selector.record(a, 0.2)
+    assert selector([a, b]) is b
+    selector.record(b, 0.4)
+    assert selector([a, b]) is a
+    selector.record(a, 1.0)
+    assert selector.latencies[a] == pytest.approx(0.6)
+    assert selector([a, b]) is b
+
+    db.selector = jhhalchemy.model.replica.LeastLatency()
+    jhhalchemy.model.replica._time_statements(a, db.selector)
+    with pytest.raises(sqlalchemy.exc.OperationalError):
+        a.execute('SELECT missing FROM nowhere')
+    assert a not in db.selector.latencies
+    a.execute('SELECT 1')
+    assert a in db.selector.latencies
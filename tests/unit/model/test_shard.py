@@ -0,0 +1,81 @@
+"""
+Unit tests for shard routing, against SQLite databases standing in for the shards
+"""
+import jhhalchemy.model
+import jhhalchemy.model.shard
+import pytest
+import sqlalchemy
+
+
+@pytest.fixture
+def router(model_cls, tmpdir):
+    """
+    Create a router over two SQLite shards with the model's table, without the MySQL server defaults.
+
+    :param model_cls: mapped model class
+    :param tmpdir: pytest temporary directory
+    :return: ShardRouter
+    """
+    router = jhhalchemy.model.shard.ShardRouter(dict(
+        ('shard_{}'.format(i), 'sqlite:///{}'.format(tmpdir.join('shard_{}.db'.format(i)))) for i in range(2)))
+    table = sqlalchemy.Table(model_cls.__tablename__, sqlalchemy.MetaData(), *[
+        sqlalchemy.Column(column.name, column.type, primary_key=column.primary_key)
+        for column in model_cls.__table__.columns])
+    for engine in router.engines.values():
+        table.create(engine)
+    yield router
+    router.dispose()
+
+
+def test_modulo_chooser():
+    """
+    Verify integer keys are used as is and other keys are hashed consistently
+    """
+    chooser = jhhalchemy.model.shard.modulo_chooser(['a', 'b', 'c'])
+    assert [chooser(key) for key in range(4)] == ['a', 'b', 'c', 'a']
+    assert chooser('user@example.com') == chooser('user@example.com')
+    assert chooser('user@example.com') in ('a', 'b', 'c')
+
+
+def test_routing(router, model_cls):
+    """
+    Verify the CRUD helpers use the key's shard
+
+    :param router: ShardRouter fixture
+    :param model_cls: mapped model class
+    """
+    assert router.shard(1) == 'shard_1'
+    assert router.session(1) is router.sessions['shard_1']()
+    for uid in (1, 2, 3):
+        router.save(uid, model_cls(uid=uid, time_removed=0, time_order=-uid))
+
+    assert [model.uid for model in router.read(1, model_cls)] == [1, 3]
+    assert [model.uid for model in router.read_by(2, model_cls)] == [2]
+    assert [model.uid for model in router.get_by_range(3, model_cls, model_cls.uid == 3, start_timestamp=2)] == [3]
+
+    model = router.read_by(2, model_cls, uid=2).one()
+    router.delete(2, model, soft=False)
+    assert router.read_by(2, model_cls).count() == 0
+    assert router.read(1, model_cls).count() == 2
+
+
+def test_scatter_gather(router, model_cls):
+    """
+    Verify cross-shard reads query every shard and merge in time_order order
+
+    :param router: ShardRouter fixture
+    :param model_cls: mapped model class
+    """
+    for uid, timestamp in ((1, 10), (2, 30), (3, 20), (4, 40), (5, 5)):
+        router.save(uid, model_cls(uid=uid, time_removed=0, time_order=-timestamp))
+    router.remove()
+
+    models = router.get_by_range_all(model_cls, start_timestamp=1)
+    assert [model.uid for model in models] == [4, 2, 3, 1, 5]
+    models = router.get_by_range_all(model_cls, start_timestamp=1, asc=True)
+    assert [model.uid for model in models] == [5, 1, 3, 2, 4]
+    rows = router.get_by_range_all(model_cls, start_timestamp=1, columns=['uid', 'time_order'])
+    assert [row.uid for row in rows] == [4, 2, 3, 1, 5]
+
+    assert sorted(model.uid for model in router.read_all(model_cls)) == [1, 2, 3, 4, 5]
+    assert [model.uid for model in router.read_all(model_cls, shards=['shard_0'])] == [2, 4]
@@ -1,9 +1,26 @@
 """
 Unit tests for the TimeOrderBase model
 """
+import collections
+import jhhalchemy.model
 import jhhalchemy.model.time_order
 import mock
 import pytest
+import sqlalchemy
+import sqlalchemy.dialects.mysql
+import sqlalchemy.ext.declarative
+
+
+def literal_sql(clause):
+    """
+    Compile a column or criterion with its bound values inlined.
+
+    :param clause: SQLAlchemy clause or model attribute
+    :return: SQL string
+    """
+    if hasattr(clause, '__clause_element__'):
+        clause = clause.__clause_element__()
+    return str(clause.compile(compile_kwargs={'literal_binds': True}))
 
 
 def test_timestamp():
@@ -48,7 +65,9 @@ def test_read_time_range(mock_time_order):
         start_timestamp=start_ts,
         end_timestamp=end_ts)
     jhhalchemy.model.time_order.TimeOrderMixin.read.assert_called_once_with(col_crit, start_crit, end_crit)
-    assert timeorders == jhhalchemy.model.time_order.TimeOrderMixin.read.return_value
+    jhhalchemy.model.time_order.TimeOrderMixin.read.return_value.execution_options.assert_called_once_with(
+        jhhalchemy_helper='read_time_range')
+    assert timeorders == jhhalchemy.model.time_order.TimeOrderMixin.read.return_value.execution_options.return_value
 
     #
     # Start only
@@ -56,7 +75,117 @@ def test_read_time_range(mock_time_order):
     jhhalchemy.model.time_order.TimeOrderMixin.read.reset_mock()
     timeorders = jhhalchemy.model.time_order.TimeOrderMixin.read_time_range(start_timestamp=start_ts)
     jhhalchemy.model.time_order.TimeOrderMixin.read.assert_called_once_with(start_crit)
-    assert timeorders == jhhalchemy.model.time_order.TimeOrderMixin.read.return_value
+    assert timeorders == jhhalchemy.model.time_order.TimeOrderMixin.read.return_value.execution_options.return_value
+
+
+def test_read_time_range_columns(model_cls):
+    """
+    Verify column projection and raw rows
+
+    :param model_cls: mapped model class
+    """
+    with mock.patch.object(model_cls, 'read') as mock_read:
+        query = model_cls.read_time_range(start_timestamp=1, columns=['uid', model_cls.time_order])
+        mock_read.return_value.with_entities.assert_called_once_with(model_cls.uid, model_cls.time_order)
+        assert query == mock_read.return_value.with_entities.return_value.execution_options.return_value
+
+        mock_read.reset_mock()
+        model_cls.read_time_range(raw=True)
+        columns = [literal_sql(column) for column in mock_read.return_value.with_entities.call_args[0]]
+        assert len(columns) == 6
+        assert 'time_order_model.uid' in columns
+
+        mock_read.reset_mock()
+        model_cls.read_time_range(start_timestamp=1)
+        assert not mock_read.return_value.with_entities.called
+
+
+def test_time_order_index():
+    """
+    Verify the optional range read index
+    """
+    model = sqlalchemy.ext.declarative.declarative_base(cls=jhhalchemy.model.Base)
+
+    class IndexedModel(model, jhhalchemy.model.time_order.TimeOrderMixin):
+        __tablename__ = 'indexed_model'
+        __time_order_index__ = ('uid',)
+        name_id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+        uid = sqlalchemy.Column(sqlalchemy.Integer)
+
+    indexes = dict((index.name, [column.name for column in index.columns]) for index in IndexedModel.__table__.indexes)
+    assert indexes == {'ix_indexed_model_time_order': ['uid', 'time_removed', 'time_order']}
+
+
+def test_time_order_partitioned():
+    """
+    Verify the optional MySQL partitioning requires time_order in the primary key
+    """
+    model = sqlalchemy.ext.declarative.declarative_base(cls=jhhalchemy.model.Base)
+
+    class PartitionedModel(model, jhhalchemy.model.time_order.TimeOrderMixin):
+        __tablename__ = 'partitioned_model'
+        __time_order_partitioned__ = True
+        name_id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True, autoincrement=True)
+        time_order = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True, autoincrement=False)
+
+    ddl = str(sqlalchemy.schema.CreateTable(PartitionedModel.__table__).compile(
+        dialect=sqlalchemy.dialects.mysql.dialect()))
+    assert 'PRIMARY KEY (name_id, time_order)' in ddl
+    assert ddl.endswith('PARTITION BY RANGE (time_order) (PARTITION p_old VALUES LESS THAN MAXVALUE)\n\n')
+
+    class UnpartitionableModel(model, jhhalchemy.model.time_order.TimeOrderMixin):
+        __tablename__ = 'unpartitionable_model'
+        __time_order_partitioned__ = True
+        name_id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+
+    connection = mock.Mock()
+    connection.dialect.name = 'mysql'
+    jhhalchemy.model.time_order._check_partition_key(PartitionedModel.__table__, connection)
+    with pytest.raises(sqlalchemy.exc.ArgumentError):
+        UnpartitionableModel.__table__.dispatch.before_create(UnpartitionableModel.__table__, connection)
+
+
+def test_read_as_of():
+    """
+    Verify the point in time lookup.
+    """
+    read = jhhalchemy.model.time_order.TimeOrderMixin.read = mock.Mock()
+    with mock.patch('jhhalchemy.model.time_order.TimeOrderMixin.time_order') as mock_time_order:
+        mock_time_order.__ge__ = mock.Mock()
+        model = jhhalchemy.model.time_order.TimeOrderMixin.read_as_of(10, 'criterion')
+        mock_time_order.__ge__.assert_called_once_with(-10)
+        read.assert_called_once_with(mock_time_order.__ge__.return_value, 'criterion')
+        read.return_value.execution_options.assert_called_once_with(jhhalchemy_helper='read_as_of')
+        query = read.return_value.execution_options.return_value
+        query.order_by.assert_called_once_with(mock_time_order)
+        assert model == query.order_by.return_value.first.return_value
+
+
+@mock.patch('sqlalchemy.orm.Query.__iter__', autospec=True)
+def test_read_as_of_many(mock_iter, model_cls):
+    """
+    Verify one groupwise-max query per batch of keys
+
+    :param mock_iter: mocked query execution
+    :param model_cls: mapped model class
+    """
+    queries = []
+    rows = [[model_cls(uid=1, time_order=-5), model_cls(uid=1, time_order=-5)], [model_cls(uid=3, time_order=-7)]]
+
+    def execute(query):
+        queries.append(str(query))
+        return iter(rows[len(queries) - 1])
+    mock_iter.side_effect = execute
+
+    with mock.patch.object(model_cls, 'query', sqlalchemy.orm.Query(model_cls)):
+        models = model_cls.read_as_of_many(model_cls.uid, [1, 2, 3], 10, batch_size=2)
+    assert len(queries) == 2
+    sql = queries[0]
+    assert 'JOIN (SELECT time_order_model.uid AS latest_key, min(time_order_model.time_order) AS time_order' in sql
+    assert 'WHERE time_order_model.time_removed = :time_removed_1 AND time_order_model.uid IN (:uid_1, :uid_2)' in sql
+    assert 'GROUP BY time_order_model.uid) AS anon_1 ' \
+        'ON time_order_model.uid = anon_1.latest_key AND time_order_model.time_order = anon_1.time_order' in sql
+    assert models == {1: rows[0][0], 2: None, 3: rows[1][0]}
 
 
 def test_get_timezones_by_range():
@@ -82,7 +211,7 @@ def test_get_timezones_by_range():
     models = jhhalchemy.model.time_order.get_by_range(model_cls, col)
     model_cls.read_time_range.assert_called_once_with(col, end_timestamp=None)
     model_cls.read_time_range.return_value.order_by.assert_called_once_with(model_cls.time_order)
-    assert models == model_cls.read_time_range.return_value.order_by.return_value
+    assert models == model_cls.read_time_range.return_value.order_by.return_value.execution_options.return_value
 
     #
     # start <= end -> read
@@ -93,14 +222,14 @@ def test_get_timezones_by_range():
     # => [between, on start]
     end_ts = 100
     model_cls.reset_mock()
-    model_cls.read_time_range.return_value.order_by.return_value = [
+    model_cls.read_time_range.return_value.order_by.return_value.execution_options.return_value = [
         mock.Mock(timestamp=end_ts - 1),
         mock.Mock(timestamp=start_ts),
         mock.Mock(timestamp=start_ts - 1)]
     models = jhhalchemy.model.time_order.get_by_range(model_cls, col, start_timestamp=start_ts, end_timestamp=end_ts)
     model_cls.read_time_range.assert_called_once_with(col, end_timestamp=end_ts)
     model_cls.read_time_range.return_value.order_by.assert_called_once_with(model_cls.time_order)
-    assert models == model_cls.read_time_range.return_value.order_by.return_value[:2]
+    assert models == model_cls.read_time_range.return_value.order_by.return_value.execution_options.return_value[:2]
 
     #
     # Another read case
@@ -111,21 +240,239 @@ def test_get_timezones_by_range():
     # => [on end, between, before start]
     #
     model_cls.reset_mock()
-    model_cls.read_time_range.return_value.order_by.return_value = [
+    model_cls.read_time_range.return_value.order_by.return_value.execution_options.return_value = [
         mock.Mock(timestamp=end_ts),
         mock.Mock(timestamp=end_ts - 1),
         mock.Mock(timestamp=start_ts - 1)]
     models = jhhalchemy.model.time_order.get_by_range(model_cls, col, start_timestamp=start_ts, end_timestamp=end_ts)
     model_cls.read_time_range.assert_called_once_with(col, end_timestamp=end_ts)
     model_cls.read_time_range.return_value.order_by.assert_called_once_with(model_cls.time_order)
-    assert models == model_cls.read_time_range.return_value.order_by.return_value
+    assert models == model_cls.read_time_range.return_value.order_by.return_value.execution_options.return_value
 
     #
     # No models in the DB
     #
     model_cls.reset_mock()
-    model_cls.read_time_range.return_value.order_by.return_value = []
+    model_cls.read_time_range.return_value.order_by.return_value.execution_options.return_value = []
     models = jhhalchemy.model.time_order.get_by_range(model_cls, col, start_timestamp=start_ts)
     model_cls.read_time_range.assert_called_once_with(col, end_timestamp=None)
     model_cls.read_time_range.return_value.order_by.assert_called_once_with(model_cls.time_order)
     assert models == []
+
+
+@mock.patch('jhhalchemy.model.time_order.get_by_range', autospec=True)
+def test_get_by_range_many(mock_get, model_cls):
+    """
+    Verify one IN query per batch of keys, grouped by key in time order
+
+    :param mock_get: mocked get_by_range
+    :param model_cls: mapped model class
+    """
+    models = [
+        model_cls(uid=2, time_order=-3),
+        model_cls(uid=1, time_order=-2),
+        model_cls(uid=2, time_order=-1),
+        model_cls(uid=4, time_order=-1)]
+    mock_get.side_effect = [models[:3], models[3:]]
+    grouped = jhhalchemy.model.time_order.get_by_range_many(
+        model_cls, model_cls.uid, [1, 2, 3, 4], start_timestamp=1, asc=True, batch_size=3)
+    assert list(grouped.items()) == [(1, [models[1]]), (2, [models[0], models[2]]), (3, []), (4, [models[3]])]
+    assert mock_get.call_args_list == [
+        mock.call(model_cls, mock.ANY, start_timestamp=1, asc=True),
+        mock.call(model_cls, mock.ANY, start_timestamp=1, asc=True)]
+    assert literal_sql(mock_get.call_args_list[0][0][1]) == 'time_order_model.uid IN (1, 2, 3)'
+    assert literal_sql(mock_get.call_args_list[1][0][1]) == 'time_order_model.uid IN (4)'
+
+    #
+    # The key column is selected to group the rows even if columns leaves it out
+    #
+    Row = collections.namedtuple('Row', ['time_order', 'uid'])
+    mock_get.side_effect = [[Row(-1, 2)]]
+    grouped = jhhalchemy.model.time_order.get_by_range_many(model_cls, model_cls.uid, [1, 2], columns=['time_order'])
+    assert list(grouped.items()) == [(1, []), (2, [Row(-1, 2)])]
+    assert mock_get.call_args[1] == {'columns': [model_cls.time_order, model_cls.uid]}
+
+
+def test_cursor():
+    """
+    Verify cursors round trip and reject garbage or the wrong direction
+    """
+    cursor = jhhalchemy.model.time_order._encode_cursor([-10, 3], False)
+    assert jhhalchemy.model.time_order._decode_cursor(cursor, False, 2) == [-10, 3]
+    with pytest.raises(jhhalchemy.model.time_order.InvalidCursor):
+        jhhalchemy.model.time_order._decode_cursor(cursor, True, 2)
+    with pytest.raises(jhhalchemy.model.time_order.InvalidCursor):
+        jhhalchemy.model.time_order._decode_cursor(cursor, False, 3)
+    with pytest.raises(jhhalchemy.model.time_order.InvalidCursor):
+        jhhalchemy.model.time_order._decode_cursor('not a cursor', False, 2)
+
+
+@mock.patch('jhhalchemy.model.time_order.get_by_range', autospec=True)
+def test_get_page(mock_get, model_cls):
+    """
+    Verify keyset pagination
+
+    :param mock_get: mocked get_by_range
+    :param model_cls: mapped model class
+    """
+    query = mock_get.return_value.order_by.return_value
+    query.execution_options.return_value = query
+    query.filter.return_value = query
+    query.limit.return_value.all.return_value = [
+        model_cls(name_id=1, time_order=-30),
+        model_cls(name_id=2, time_order=-20),
+        model_cls(name_id=3, time_order=-10)]
+
+    #
+    # First page: newest first, ties broken by primary key, one extra row to detect the next page
+    #
+    page = jhhalchemy.model.time_order.get_page(model_cls, model_cls.uid == 1, start_timestamp=5, limit=2)
+    mock_get.assert_called_once_with(
+        model_cls, mock.ANY, start_timestamp=5, end_timestamp=None, asc=False)
+    assert literal_sql(mock_get.return_value.order_by.call_args[0][0]) == 'time_order_model.id'
+    query.execution_options.assert_called_once_with(jhhalchemy_helper='get_page')
+    assert not query.filter.called
+    query.limit.assert_called_once_with(3)
+    assert [model.name_id for model in page.models] == [1, 2]
+    assert jhhalchemy.model.time_order._decode_cursor(page.cursor, False, 2) == [-20, 2]
+
+    #
+    # Next page seeks past the cursor
+    #
+    query.limit.return_value.all.return_value = [model_cls(name_id=3, time_order=-10)]
+    page = jhhalchemy.model.time_order.get_page(model_cls, cursor=page.cursor, limit=2)
+    assert literal_sql(query.filter.call_args[0][0]) == (
+        'time_order_model.time_order > -20 OR '
+        'time_order_model.time_order = -20 AND time_order_model.id > 2')
+    assert [model.name_id for model in page.models] == [3]
+    assert page.cursor is None
+
+    #
+    # Ascending timestamps scan the other way
+    #
+    query.reset_mock()
+    cursor = jhhalchemy.model.time_order._encode_cursor([-20, 2], True)
+    jhhalchemy.model.time_order.get_page(model_cls, cursor=cursor, asc=True)
+    assert literal_sql(mock_get.return_value.order_by.call_args[0][0]) == 'time_order_model.id DESC'
+    assert literal_sql(query.filter.call_args[0][0]) == (
+        'time_order_model.time_order < -20 OR '
+        'time_order_model.time_order = -20 AND time_order_model.id < 2')
+    query.limit.assert_called_once_with(jhhalchemy.model.time_order.PAGE_SIZE + 1)
+
+    #
+    # Raw pages select plain tuples of every column
+    #
+    query.reset_mock()
+    jhhalchemy.model.time_order.get_page(model_cls, raw=True)
+    columns = [literal_sql(column) for column in query.with_entities.call_args[0]]
+    assert 'time_order_model.id' in columns
+    assert 'time_order_model.time_order' in columns
+    assert len(columns) == 6
+    query.with_entities.return_value.limit.assert_called_once_with(jhhalchemy.model.time_order.PAGE_SIZE + 1)
+
+    #
+    # Projected pages keep the cursor columns
+    #
+    query.reset_mock()
+    jhhalchemy.model.time_order.get_page(model_cls, columns=['uid'])
+    assert [literal_sql(column) for column in query.with_entities.call_args[0]] == [
+        'time_order_model.uid', 'time_order_model.time_order', 'time_order_model.id']
+
+    #
+    # Cursor from the other direction
+    #
+    with pytest.raises(jhhalchemy.model.time_order.InvalidCursor):
+        jhhalchemy.model.time_order.get_page(model_cls, cursor=cursor)
+
+
+@mock.patch('jhhalchemy.model.time_order.get_page', autospec=True)
+def test_iter_by_range(mock_page, model_cls):
+    """
+    Verify batches follow the page cursors and the stats add up
+
+    :param mock_page: mocked get_page
+    :param model_cls: mapped model class
+    """
+    page = jhhalchemy.model.time_order.Page
+    mock_page.side_effect = [page([1, 2], 'first'), page([3], 'second'), page([], None)]
+    stats = jhhalchemy.model.time_order.StreamStats()
+    assert stats.rows_per_second == 0.0
+    batches = list(jhhalchemy.model.time_order.iter_by_range(
+        model_cls, model_cls.uid == 1, start_timestamp=1, batch_size=2, stats=stats))
+    assert batches == [[1, 2], [3]]
+    assert mock_page.call_args_list == [
+        mock.call(model_cls, mock.ANY, start_timestamp=1, limit=2),
+        mock.call(model_cls, mock.ANY, start_timestamp=1, limit=2, cursor='first'),
+        mock.call(model_cls, mock.ANY, start_timestamp=1, limit=2, cursor='second')]
+    assert stats.rows == 3
+    assert stats.batches == 3
+    assert stats.peak_batch == 2
+    assert stats.rows_per_second >= 0
+
+
+@mock.patch('jhhalchemy.model.time_order.iter_by_range', autospec=True)
+def test_get_columns(mock_iter, model_cls):
+    """
+    Verify batches are appended to typed arrays and timestamps are converted from time_order
+
+    :param mock_iter: mocked iter_by_range
+    :param model_cls: mapped model class
+    """
+    mock_iter.return_value = [[(1, 5, -30, 1), (2, None, -20, 2)], [(3, 7, -10, 3)]]
+    columns = jhhalchemy.model.time_order.get_columns(
+        model_cls, ['name_id', model_cls.uid], model_cls.uid > 1, start_timestamp=5, use_numpy=False)
+    mock_iter.assert_called_once_with(
+        model_cls, mock.ANY, start_timestamp=5, batch_size=jhhalchemy.model.time_order.COLUMN_BATCH_SIZE,
+        columns=[model_cls.name_id, model_cls.uid, model_cls.time_order])
+    assert list(columns) == ['name_id', 'uid', 'timestamp']
+    assert columns['name_id'].typecode == jhhalchemy.model.time_order.INTEGER_TYPECODE
+    assert list(columns['name_id']) == [1, 2, 3]
+    assert columns['uid'].typecode == 'd'
+    assert columns['uid'][0] == 5 and columns['uid'][1] != columns['uid'][1] and columns['uid'][2] == 7
+    assert list(columns['timestamp']) == [30, 20, 10]
+
+
+@pytest.mark.skipif(jhhalchemy.model.time_order.numpy is None, reason='NumPy is not installed')
+@mock.patch('jhhalchemy.model.time_order.iter_by_range', autospec=True)
+def test_get_columns_numpy(mock_iter, model_cls):
+    """
+    Verify the arrays are returned as ndarrays when NumPy is installed
+
+    :param mock_iter: mocked iter_by_range
+    :param model_cls: mapped model class
+    """
+    mock_iter.return_value = [[(1, 5, -30, 1), (2, None, -20, 2)]]
+    columns = jhhalchemy.model.time_order.get_columns(model_cls, [model_cls.name_id, model_cls.uid])
+    assert columns['name_id'].dtype.kind == 'i'
+    assert columns['timestamp'].tolist() == [30, 20]
+    assert columns['uid'].dtype.kind == 'f'
+    assert jhhalchemy.model.time_order.numpy.isnan(columns['uid'][1])
+
+
+def test_aggregate_range(model_cls):
+    """
+    Verify the bucketed GROUP BY and range validation
+
+    :param model_cls: mapped model class
+    """
+    with mock.patch.object(model_cls, 'query', sqlalchemy.orm.Query(model_cls)):
+        query = model_cls.aggregate_range(
+            3600, [('count', sqlalchemy.func.count()), ('uids', sqlalchemy.func.count(model_cls.uid.distinct()))],
+            model_cls.uid > 1, start_timestamp=10, end_timestamp=20)
+        bucket = 'floor((-time_order_model.time_order) / 3600) * 3600'
+        assert ' '.join(literal_sql(query.statement).split()) == (
+            'SELECT {0} AS bucket, count(*) AS count, count(DISTINCT time_order_model.uid) AS uids '
+            'FROM time_order_model '
+            'WHERE time_order_model.time_removed = 0 AND time_order_model.uid > 1 '
+            'AND time_order_model.time_order <= -10 AND time_order_model.time_order >= -20 '
+            'GROUP BY {0} ORDER BY {0}'.format(bucket))
+        assert query.get_execution_options()['jhhalchemy_helper'] == 'aggregate_range'
+
+        query = model_cls.aggregate_range(86400, {'count': sqlalchemy.func.count()}, offset_seconds=-28800)
+        assert 'floor((-time_order_model.time_order + -28800) / 86400) * 86400 - -28800 AS bucket' in literal_sql(
+            query.statement)
+
+        with pytest.raises(ValueError):
+            model_cls.aggregate_range(0, {'count': sqlalchemy.func.count()})
+        with pytest.raises(jhhalchemy.model.time_order.InvalidTimestampRange):
+            model_cls.aggregate_range(60, {'count': sqlalchemy.func.count()}, start_timestamp=2, end_timestamp=1)
@@ -0,0 +1,74 @@
+"""
+Unit tests for the shared engine factory and pool metrics, against SQLite
+"""
+import jhhalchemy.engine
+import mock
+import pytest
+import sqlalchemy
+import sqlalchemy.exc
+import sqlalchemy.pool
+
+
+@pytest.fixture
+def connect_str(tmpdir):
+    """
+    :param tmpdir: pytest temporary directory
+    :return: SQLite connection string
+    """
+    return 'sqlite:///{}'.format(tmpdir.join('engine.db'))
+
+
+def test_get_engine(connect_str):
+    """
+    Verify engines are shared per process, preset and options
+
+    :param connect_str: SQLite connection string
+    """
+    engine = jhhalchemy.engine.get_engine(connect_str)
+    assert jhhalchemy.engine.get_engine(connect_str) is engine
+    assert isinstance(engine.pool, jhhalchemy.engine.InstrumentedQueuePool)
+    assert engine.pool.size() == jhhalchemy.engine.PRESETS['default']['pool_size']
+    assert jhhalchemy.engine.get_engine(connect_str, 'migration') is not engine
+    assert jhhalchemy.engine.get_engine(connect_str, pool_size=1).pool.size() == 1
+
+    with mock.patch('os.getpid', return_value=-1):
+        assert jhhalchemy.engine.get_engine(connect_str) is not engine
+
+    #
+    # Options with dicts, e.g. connect_args, are part of the key too
+    #
+    with_args = jhhalchemy.engine.get_engine(connect_str, connect_args={'timeout': 5, 'check_same_thread': False})
+    same_args = {'check_same_thread': False, 'timeout': 5}
+    assert jhhalchemy.engine.get_engine(connect_str, connect_args=same_args) is with_args
+    assert jhhalchemy.engine.get_engine(connect_str, connect_args={'timeout': 10}) is not with_args
+    assert with_args is not engine
+
+
+def test_pool_metrics(connect_str):
+    """
+    Verify checkouts, overflows, timeouts and invalidations are counted, also across dispose
+
+    :param connect_str: SQLite connection string
+    """
+    engine = jhhalchemy.engine.get_engine(connect_str, 'worker', pool_size=1, max_overflow=1, pool_timeout=0.1)
+    first = engine.connect()
+    second = engine.connect()
+    with pytest.raises(sqlalchemy.exc.TimeoutError):
+        engine.connect()
+    metrics = jhhalchemy.engine.pool_metrics(engine)
+    assert metrics['checked_out'] == 2
+    assert metrics['overflow'] == 1
+    assert (metrics['checkouts'], metrics['overflows'], metrics['timeouts'], metrics['connects']) == (2, 1, 1, 2)
+    assert metrics['max_wait_seconds'] <= metrics['wait_seconds']
+
+    first.invalidate()
+    first.close()
+    second.close()
+    engine.dispose()
+    engine.connect().close()
+    metrics = jhhalchemy.engine.pool_metrics(engine)
+    assert (metrics['checkouts'], metrics['connects'], metrics['invalidations']) == (3, 3, 1)
+    assert metrics['checked_out'] == 0
+
+    engine = sqlalchemy.create_engine(connect_str, poolclass=sqlalchemy.pool.QueuePool)
+    assert set(jhhalchemy.engine.pool_metrics(engine)) == {'size', 'checked_out', 'overflow'}
@@ -0,0 +1,129 @@
+"""
+Unit tests for query instrumentation
+"""
+import jhhalchemy.instrument
+import mock
+import pytest
+import sqlalchemy
+import sqlalchemy.exc
+
+
+@pytest.fixture
+def engine():
+    """
+    In-memory SQLite engine to fire real cursor events
+
+    :return: engine
+    """
+    engine = sqlalchemy.create_engine('sqlite://')
+    engine.execute('CREATE TABLE tom (id INTEGER PRIMARY KEY)')
+    engine.execute('INSERT INTO tom (id) VALUES (1), (2)')
+    return engine
+
+
+def test_tag():
+    """
+    Verify helpers tag queries with execution options
+    """
+    query = mock.Mock()
+    model_cls = mock.Mock(__name__='MyModel')
+    assert jhhalchemy.instrument.tag(query, model_cls, 'read') == query.execution_options.return_value
+    query.execution_options.assert_called_once_with(jhhalchemy_model='MyModel', jhhalchemy_helper='read')
+    query.reset_mock()
+    jhhalchemy.instrument.tag(query, helper='get_by_range')
+    query.execution_options.assert_called_once_with(jhhalchemy_helper='get_by_range')
+
+
+def test_histogram():
+    """
+    Verify bucketing and counters
+    """
+    histogram = jhhalchemy.instrument.Histogram(buckets=(0.1, 1.0))
+    histogram.observe(0.05, 2)
+    histogram.observe(0.1, 3)
+    histogram.observe(5, -1)
+    assert histogram.as_dict() == {
+        'count': 3,
+        'seconds': 5.15,
+        'max_seconds': 5,
+        'rows': 5,
+        'buckets': {'0.1': 2, '1.0': 0, 'inf': 1}}
+
+
+def test_instrument(engine):
+    """
+    Verify only tagged queries are recorded, per model and helper, and sent to the emitters
+
+    :param engine: SQLite engine fixture
+    """
+    emitter = mock.Mock()
+    recorder = jhhalchemy.instrument.instrument(
+        engine, jhhalchemy.instrument.Recorder(emitters=[emitter]), slow_seconds=0)
+    select = sqlalchemy.text('SELECT id FROM tom')
+
+    engine.execute(select)
+    assert recorder.snapshot() == {}
+
+    connection = engine.connect().execution_options(jhhalchemy_model='Tom', jhhalchemy_helper='read')
+    with mock.patch.object(jhhalchemy.instrument.logger, 'warning') as mock_warning:
+        connection.execute(select).fetchall()
+        connection.execute(select).fetchall()
+        assert mock_warning.call_count == 2
+    snapshot = recorder.snapshot()
+    assert list(snapshot) == [('Tom', 'read')]
+    assert snapshot[('Tom', 'read')]['count'] == 2
+    assert emitter.emit.call_count == 2
+    assert emitter.emit.call_args[0][:2] == ('Tom', 'read')
+
+    recorder.reset()
+    assert recorder.snapshot() == {}
+
+
+@mock.patch('jhhalchemy.instrument._explain', autospec=True)
+def test_instrument_errors(mock_explain, engine):
+    """
+    Verify failed statements are not recorded and a failed EXPLAIN is logged once without failing the query
+
+    :param mock_explain: mocked _explain
+    :param engine: SQLite engine fixture
+    """
+    recorder = jhhalchemy.instrument.instrument(engine, explain=True)
+    connection = engine.connect().execution_options(jhhalchemy_model='Tom', jhhalchemy_helper='read')
+    with pytest.raises(sqlalchemy.exc.OperationalError):
+        connection.execute('SELECT missing FROM nowhere')
+    assert recorder.snapshot() == {}
+
+    mock_explain.side_effect = sqlalchemy.exc.TimeoutError('QueuePool limit reached')
+    with mock.patch.object(engine.dialect, 'name', 'mysql'), \
+            mock.patch.object(jhhalchemy.instrument.logger, 'exception') as mock_exception:
+        assert connection.execute('SELECT id FROM tom').fetchall() == [(1,), (2,)]
+        assert connection.execute('SELECT id FROM tom').fetchall() == [(1,), (2,)]
+    mock_explain.assert_called_once_with(engine, 'SELECT id FROM tom', ())
+    mock_exception.assert_called_once_with('Could not EXPLAIN Tom.read: SELECT id FROM tom')
+    assert recorder.plans == {'SELECT id FROM tom': None}
+    assert recorder.snapshot()[('Tom', 'read')]['count'] == 2
+
+
+def test_plan_problems():
+    """
+    Verify full scans and filesorts are flagged
+    """
+    plan = [
+        {'table': 'tom', 'type': 'ALL', 'Extra': 'Using where; Using filesort'},
+        {'table': 'other', 'type': 'ref', 'Extra': None}]
+    assert jhhalchemy.instrument.plan_problems(plan) == ['full scan of tom', 'filesort on tom']
+    assert jhhalchemy.instrument.plan_problems(plan[1:]) == []
+
+
+def test_emitters():
+    """
+    Verify logging and statsd emitters
+    """
+    mock_logger = mock.Mock()
+    jhhalchemy.instrument.LoggingEmitter(mock_logger, level=20).emit('Tom', 'read', 0.0125, 3)
+    mock_logger.log.assert_called_once_with(20, 'Tom.read took 12.5ms for 3 rows')
+
+    client = mock.Mock()
+    jhhalchemy.instrument.StatsdEmitter(client).emit('Tom', 'read', 0.5, 3)
+    client.timing.assert_called_once_with('jhhalchemy.Tom.read', 500)
+    client.incr.assert_called_once_with('jhhalchemy.Tom.read.rows', 3)